@@ -9,12 +9,30 @@ import requests
 import json
 import os
 import time
+import numpy as np
 import pandas as pd
 import glob
 import datetime
+import hashlib
+import importlib.util
+import contextvars
+import mmap
+import sqlite3
+import struct
+import sys
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from urllib.parse import quote
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError, RequestException
+from urllib3.util.retry import Retry
 from openpyxl import load_workbook
-from CTSgetPy import CTSgetPy as ct
+
+try:
+    import resource  # peak memory reporting, not available on Windows
+except ImportError:
+    resource = None
 
 # ================== CONFIGURATION ==================
 class Config:
@@ -22,10 +40,23 @@ class Config:
     
     # API Settings
     CLASSYFIRE_SITE = 'http://classyfire.wishartlab.com'
+    CTS_SITE = 'https://cts.fiehnlab.ucdavis.edu'
     REQUEST_TIMEOUT = 10
     REQUEST_RETRIES = 3
     BACKOFF_FACTOR = 0.3
+    RETRY_STATUS_CODES = [429, 500, 502, 503, 504]  # retried by the transport, honoring Retry-After
+    HTTP_POOL_SIZE = 16  # keep-alive connections per host
     API_DELAY = 6  # seconds between API calls
+    API_RATE_LIMIT = 1 / API_DELAY  # requests per second shared by all fetch workers
+    API_BURST = 1  # requests allowed back to back before the limiter throttles
+    FETCH_WORKERS = 4
+    
+    # Bulk Query Settings
+    CLASSYFIRE_BULK = False  # classify uncached compounds with SMILES through batch structure queries
+    BULK_BATCH_SIZE = 1000  # structures per submitted query
+    BULK_POLL_INTERVAL = 10  # seconds before the first status poll, doubled after each poll
+    BULK_POLL_MAX_INTERVAL = 120
+    BULK_TIMEOUT = 3600  # seconds to wait for all queries before falling back to per-entity lookups
     
     # Folder Paths
     SOURCE_FOLDER = 'data/clean_result'
@@ -33,26 +64,1444 @@ class Config:
     FINAL_RESULT_FOLDER = 'data/final_result'
     CONVERT_RESULT_FOLDER = 'data/convert_result'
     METABOANALYST_FOLDER = 'data/metaboanalyst_pubchem'
+    ROLLUP_FOLDER = 'data/class_rollup'  # per-level abundance rollups written by step 5
+    
+    # Export Watcher Settings
+    EXPORT_STABLE_SECONDS = 1.0  # unchanged size/mtime for this long marks a CSV/TXT export complete
+    EXPORT_SENTINEL_SUFFIX = '.done'  # 'sample.xlsx.done' marks 'sample.xlsx' complete immediately
+    EXPORT_POLL_INTERVAL = 0.1  # seconds between scans when watchdog is not installed
+    
+    # Web Job Settings
+    JOB_FOLDER = 'data/jobs'  # each web job writes its results to JOB_FOLDER/<job ID>
+    JOB_WORKERS = 2  # web jobs running at once; MS-DIAL itself still runs one job at a time
+    JOB_RETENTION_DAYS = 7  # result folders of finished jobs older than this are removed
     
     # Conversion Settings
     CONVERSION_SOURCE = 'InChIKey'
     CONVERSION_TARGETS = ['Human Metabolome Database', 'KEGG', 'PubChem CID', 'ChEBI']
+    CTS_RATE_LIMIT = None  # requests per second, None for unlimited
+    CTS_WORKERS = 8
     
     # Output Settings
     MERGE_OUTPUT_FILE = 'merge_result.csv'
+    INTERMEDIATE_FORMAT = 'csv'  # 'csv' or 'parquet' (needs pyarrow) for grouping/final/convert results
+    CHUNK_SIZE = None  # rows per chunk to stream large tables with bounded memory, None loads whole tables
+    
+    # Cache Settings
+    CACHE_ENABLED = True
+    CACHE_PATH = 'data/cache/classyfire_cache.sqlite'
+    CACHE_TTL_DAYS = 90  # entries older than this are refetched
+    CACHE_MAX_ENTRIES = 200000  # least recently used entries are evicted beyond this
+    CONVERSION_CACHE_PATH = 'data/cache/cts_cache.sqlite'
+    CONVERSION_CACHE_TTL_DAYS = None  # identifier mappings are kept until deleted
+    SNAPSHOT_PATH = 'data/cache/classyfire_snapshot.idx'  # offline index built by build_snapshot_index
+    SKELETON_MATCH = True  # classify keys ClassyFire has no entity for from a local entry sharing their first block
+    
+    # Checkpoint Settings
+    CHECKPOINT_FOLDER = 'data/checkpoint'
+    CLASSIFICATION_JOURNAL = 'classification_journal.jsonl'
+    
+    # Incremental Settings
+    INCREMENTAL = False  # only recompute files whose inputs changed since the last run
+    MANIFEST_PATH = 'data/pipeline_manifest.json'
+    
+    # Parallelism Settings
+    PROCESS_WORKERS = 1  # worker processes for per-file work in steps 2-4, 1 runs serially
+    
+    # Run Report Settings
+    RUN_REPORT_FOLDER = 'data/run_report'  # JSON timings and counters of each run
+
+
+# ================== RUN METRICS ==================
+class RunMetrics:
+    """
+    Counters and per-file timings collected while steps run
+    
+    Each pipeline owns one and activates it while its steps run, so pipelines
+    running concurrently in one process keep separate totals. Counters
+    incremented in pool workers are merged back when their task finishes.
+    """
+    
+    def __init__(self):
+        self.counters = {}
+        self.files = []
+        self._lock = threading.Lock()
+    
+    def count(self, name: str, amount: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+    
+    def merge(self, counters: dict):
+        for name, amount in counters.items():
+            self.count(name, amount)
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.counters)
+    
+    def add_file(self, task: str, name: str, seconds: float, counters: dict):
+        with self._lock:
+            self.files.append({'task': task, 'file': name, 'seconds': round(seconds, 3), **counters})
+    
+    @contextmanager
+    def measure_file(self, task: str, name: str):
+        """Record the time and counters spent on one file"""
+        before = self.snapshot()
+        start = time.perf_counter()
+        yield
+        self.add_file(task, name, time.perf_counter() - start, counter_delta(before, self.snapshot()))
+    
+    @contextmanager
+    def activate(self):
+        """Route counts made in this thread, and threads it starts, to these metrics"""
+        token = _ACTIVE_METRICS.set(self)
+        try:
+            yield self
+        finally:
+            _ACTIVE_METRICS.reset(token)
+
+
+# Fallback for counts made outside a pipeline, e.g. in pool worker processes
+METRICS = RunMetrics()
+_ACTIVE_METRICS = contextvars.ContextVar('active_metrics', default=None)
+
+
+def current_metrics() -> RunMetrics:
+    """Metrics of the pipeline running in this context, or the process-wide fallback"""
+    return _ACTIVE_METRICS.get() or METRICS
+
+
+def counter_delta(before: dict, after: dict) -> dict:
+    """Counters that changed between two snapshots"""
+    return {
+        name: round(value - before.get(name, 0), 3)
+        for name, value in after.items() if value != before.get(name, 0)
+    }
+
+
+def peak_rss_mb() -> dict:
+    """Peak resident memory of this process and its finished children, in MB"""
+    if resource is None:
+        return {}
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return {
+        'self': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        'children': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1)
+    }
+
+
+def _retry_count(response: requests.Response) -> int:
+    """Number of transport-level retries urllib3 made for a response"""
+    retries = getattr(response.raw, 'retries', None)
+    return len(retries.history) if retries is not None else 0
+
+
+class RunReport:
+    """Per-step timings and counters of a pipeline run, saved as JSON"""
+    
+    def __init__(self, config: Config, metrics: RunMetrics = None):
+        self.config = config
+        self.metrics = metrics or RunMetrics()
+        self.started = datetime.datetime.now()
+        self.steps = []
+        self.path = os.path.join(
+            config.RUN_REPORT_FOLDER,
+            f"run_report_{self.started.strftime('%Y-%m-%d_%H-%M-%S')}.json"
+        )
+    
+    @contextmanager
+    def step(self, number: int, name: str):
+        """Time a step and attach the counters and files it produced"""
+        entry = {'step': number, 'name': name, 'status': 'running'}
+        self.steps.append(entry)
+        before = self.metrics.snapshot()
+        files_before = len(self.metrics.files)
+        wall_start = time.perf_counter()
+        cpu_start = os.times()
+        try:
+            yield entry
+            entry['status'] = 'completed'
+        except Exception:
+            entry['status'] = 'failed'
+            raise
+        finally:
+            cpu_end = os.times()
+            counters = counter_delta(before, self.metrics.snapshot())
+            entry['wall_seconds'] = round(time.perf_counter() - wall_start, 3)
+            # Work time is CPU time of this process and of pool workers that finished
+            entry['work_seconds'] = round(sum(cpu_end[:4]) - sum(cpu_start[:4]), 3)
+            entry['sleep_seconds'] = round(
+                counters.get('rate_limit_sleep_seconds', 0) + counters.get('bulk_poll_sleep_seconds', 0), 3
+            )
+            entry['counters'] = counters
+            entry['peak_rss_mb'] = peak_rss_mb()
+            entry['files'] = self.metrics.files[files_before:]
+    
+    def save(self) -> str:
+        """Write the report and return its path"""
+        os.makedirs(self.config.RUN_REPORT_FOLDER, exist_ok=True)
+        report = {
+            'started': self.started.isoformat(timespec='seconds'),
+            'saved': datetime.datetime.now().isoformat(timespec='seconds'),
+            'settings': {
+                'process_workers': self.config.PROCESS_WORKERS,
+                'fetch_workers': self.config.FETCH_WORKERS,
+                'api_rate_limit': self.config.API_RATE_LIMIT,
+                'chunk_size': self.config.CHUNK_SIZE,
+                'intermediate_format': self.config.INTERMEDIATE_FORMAT,
+                'incremental': self.config.INCREMENTAL
+            },
+            'wall_seconds': round(sum(step.get('wall_seconds', 0) for step in self.steps), 3),
+            'peak_rss_mb': peak_rss_mb(),
+            'steps': self.steps
+        }
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        return self.path
+
+
+# ================== TABLE LOADING ==================
+SOURCE_EXTENSIONS = ('.xlsx', '.xls', '.csv', '.tsv', '.txt')
+INTERMEDIATE_EXTENSIONS = SOURCE_EXTENSIONS + ('.parquet',)
+SNIFF_LINES = 20  # leading lines searched for an MS-DIAL alignment header
+ALIGNMENT_HEADER = 'Alignment ID'
+# Pipeline column -> names MS-DIAL uses for it in peak list and alignment exports
+COLUMN_ALIASES = {
+    'Title': ['Name', 'Metabolite name'],
+    'InChIKey': ['INCHIKEY'],
+}
+
+
+def _has_module(name: str) -> bool:
+    return importlib.util.find_spec(name) is not None
+
+
+def _pandas_version() -> tuple:
+    return tuple(int(part) for part in pd.__version__.split('.')[:2])
+
+
+def sniff_table(path: str) -> dict:
+    """
+    Detect the layout of a table file from its content rather than its extension
+    
+    Args:
+        path: Path to an Excel, Parquet or delimited text file
+        
+    Returns:
+        Dictionary with 'kind' ('excel', 'parquet' or 'text') and, for text
+        files, the 'sep', 'encoding', 'header_row' index and 'header' column names
+    """
+    with open(path, 'rb') as f:
+        head = f.read(64 * 1024)
+    
+    if head.startswith((b'PK\x03\x04', b'\xd0\xcf\x11\xe0')):
+        return {'kind': 'excel'}
+    if head.startswith(b'PAR1'):
+        return {'kind': 'parquet'}
+    
+    encoding = 'utf-8-sig' if head.startswith(b'\xef\xbb\xbf') else 'utf-8'
+    text = head.decode(encoding, errors='replace')
+    # Blank lines are skipped by the parser, so they are not counted here either
+    lines = [line for line in text.splitlines()[:SNIFF_LINES] if line.strip()]
+    first = lines[0] if lines else ''
+    sep = '\t' if first.count('\t') >= first.count(',') and '\t' in first else ','
+    
+    # MS-DIAL alignment exports put sample metadata rows above the real header
+    header_row = 0
+    for index, line in enumerate(lines):
+        if ALIGNMENT_HEADER in line.split(sep):
+            header_row = index
+            break
+    header_line = lines[header_row] if lines else ''
+    header = [name.strip().strip('"') for name in header_line.split(sep)]
+    
+    return {
+        'kind': 'text',
+        'sep': sep,
+        'encoding': encoding,
+        'header_row': header_row,
+        'header': header
+    }
+
+
+def load_table(path: str, columns: list = None) -> pd.DataFrame:
+    """
+    Load any table the pipeline accepts, reading only the requested columns
+    
+    Args:
+        path: Path to an xlsx/xls, csv, tsv, MS-DIAL text or Parquet file
+        columns: Columns to read (missing ones are ignored); MS-DIAL's names
+            in COLUMN_ALIASES also match. None reads every column.
+        
+    Returns:
+        DataFrame with MS-DIAL column names normalized, without any columns
+        if none of the requested ones exist
+    """
+    layout = sniff_table(path)
+    wanted = _wanted_columns(columns)
+    
+    if wanted is not None and layout['kind'] == 'text' \
+            and not any(name in wanted for name in layout['header']):
+        # An empty usecols would make the pyarrow engine read every column
+        return pd.DataFrame()
+    
+    if layout['kind'] == 'excel':
+        engine = 'calamine' if _has_module('python_calamine') and _pandas_version() >= (2, 2) else None
+        df = pd.read_excel(
+            path,
+            engine=engine,
+            usecols=(lambda name: name in wanted) if wanted is not None else None
+        )
+    elif layout['kind'] == 'parquet':
+        df = pd.read_parquet(path)
+        if wanted is not None:
+            df = df[[name for name in df.columns if name in wanted]]
+    else:
+        usecols = None
+        if wanted is not None:
+            usecols = [name for name in layout['header'] if name in wanted]
+        df = pd.read_csv(
+            path,
+            sep=layout['sep'],
+            encoding=layout['encoding'],
+            header=layout['header_row'],
+            usecols=usecols,
+            engine='pyarrow' if _has_module('pyarrow') else 'c'
+        )
+    
+    current_metrics().count('bytes_read', os.path.getsize(path))
+    current_metrics().count('rows_read', len(df))
+    return _normalize_columns(df)
+
+
+def iter_table_chunks(path: str, columns: list = None, chunksize: int = None):
+    """
+    Stream a table in chunks of at most chunksize rows
+    
+    Args:
+        path: Path to any table load_table accepts
+        columns: Columns to read, as for load_table
+        chunksize: Rows per chunk; None yields the whole table as one chunk
+        
+    Yields:
+        DataFrames with MS-DIAL column names normalized; at least one, possibly empty
+    """
+    if not chunksize:
+        yield load_table(path, columns)
+        return
+    
+    current_metrics().count('bytes_read', os.path.getsize(path))
+    for chunk in _stream_table(path, columns, chunksize):
+        current_metrics().count('rows_read', len(chunk))
+        yield chunk
+
+
+def _stream_table(path: str, columns: list, chunksize: int):
+    layout = sniff_table(path)
+    wanted = _wanted_columns(columns)
+    
+    yielded = False
+    names = []
+    if layout['kind'] == 'excel':
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            header = [str(name) if name is not None else '' for name in next(rows, ())]
+            keep = [i for i, name in enumerate(header) if wanted is None or name in wanted]
+            names = [header[i] for i in keep]
+            
+            batch = []
+            for row in rows:
+                batch.append([row[i] if i < len(row) else None for i in keep])
+                if len(batch) >= chunksize:
+                    yield _normalize_columns(pd.DataFrame(batch, columns=names))
+                    yielded = True
+                    batch = []
+            if batch:
+                yield _normalize_columns(pd.DataFrame(batch, columns=names))
+                yielded = True
+        finally:
+            workbook.close()
+    elif layout['kind'] == 'parquet':
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(path)
+        names = [name for name in parquet_file.schema_arrow.names if wanted is None or name in wanted]
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=names):
+            yield _normalize_columns(batch.to_pandas())
+            yielded = True
+    else:
+        names = [name for name in layout['header'] if wanted is None or name in wanted]
+        if not names:
+            yield pd.DataFrame()
+            return
+        reader = pd.read_csv(
+            path,
+            sep=layout['sep'],
+            encoding=layout['encoding'],
+            header=layout['header_row'],
+            usecols=names if wanted is not None else None,
+            chunksize=chunksize
+        )
+        with reader:
+            for chunk in reader:
+                yield _normalize_columns(chunk)
+                yielded = True
+    
+    if not yielded:
+        yield _normalize_columns(pd.DataFrame(columns=names))
+
+
+def _wanted_columns(columns: list) -> set:
+    """Requested columns plus their MS-DIAL aliases, None to read every column"""
+    if columns is None:
+        return None
+    wanted = set(columns)
+    for name in columns:
+        wanted.update(COLUMN_ALIASES.get(name, []))
+    return wanted
+
+
+def _normalize_columns(df: pd.DataFrame) -> pd.DataFrame:
+    renames = {}
+    for name, aliases in COLUMN_ALIASES.items():
+        if name in df.columns:
+            continue
+        alias = next((alias for alias in aliases if alias in df.columns), None)
+        if alias is not None:
+            renames[alias] = name
+    return df.rename(columns=renames) if renames else df
+
+
+def resolve_intermediate_format(config: Config) -> str:
+    """Return the configured intermediate format, falling back to CSV without pyarrow"""
+    fmt = config.INTERMEDIATE_FORMAT
+    if fmt not in ('csv', 'parquet'):
+        raise ValueError(f"Unsupported intermediate format: {fmt}")
+    if fmt == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+        print("[WARNING] pyarrow is not installed, writing intermediate results as CSV")
+        return 'csv'
+    if fmt == 'parquet' and config.CHUNK_SIZE:
+        # Chunks are appended to their output, which Parquet files do not support
+        print("[WARNING] Streaming mode writes intermediate results as CSV")
+        return 'csv'
+    return fmt
+
+
+def intermediate_name(filename: str, fmt: str) -> str:
+    """Name of the intermediate file derived from a source file name"""
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return stem + ('.parquet' if fmt == 'parquet' else '.csv')
+
+
+def _parquet_compatible(df: pd.DataFrame) -> pd.DataFrame:
+    """Store object columns mixing strings with other scalars as strings, missing values kept"""
+    mixed = {}
+    for column in df.columns[df.dtypes == object]:
+        values = df[column]
+        types = set(map(type, values[values.notna()]))
+        # Spreadsheet columns such as Title can hold 'Unknown' next to 1, which Arrow rejects
+        if str in types and len(types) > 1 and not types & {list, np.ndarray}:
+            mixed[column] = values.where(values.isna(), values.astype(str))
+    if not mixed:
+        return df
+    df = df.copy()
+    for column, values in mixed.items():
+        df[column] = values
+    return df
+
+
+def write_intermediate(df: pd.DataFrame, path: str, append: bool = False):
+    """Write an intermediate result in the format given by the file extension"""
+    size_before = os.path.getsize(path) if append and os.path.exists(path) else 0
+    if path.endswith('.parquet'):
+        if append:
+            raise ValueError(f"Cannot append to Parquet file: {path}")
+        # List columns such as Class are stored natively instead of as reprs
+        _parquet_compatible(df).to_parquet(path, index=False)
+    else:
+        df.to_csv(path, mode='a' if append else 'w', header=not append, index=False)
+    current_metrics().count('rows_written', len(df))
+    current_metrics().count('bytes_written', os.path.getsize(path) - size_before)
+
+
+# ================== HTTP SESSION ==================
+def create_http_session(config: Config) -> requests.Session:
+    """Create a pooled keep-alive session with transport-level retries and backoff"""
+    retry = Retry(
+        total=config.REQUEST_RETRIES,
+        backoff_factor=config.BACKOFF_FACTOR,
+        status_forcelist=config.RETRY_STATUS_CODES,
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=config.HTTP_POOL_SIZE,
+        pool_maxsize=config.HTTP_POOL_SIZE,
+        max_retries=retry
+    )
+    
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# ================== LOCAL CACHES ==================
+SQLITE_TIMEOUT = 30  # seconds to wait for another process's write lock on a shared cache
+SKELETON_LENGTH = 14  # first InChIKey block: connectivity without stereo, isotopes or charge
+
+
+def inchikey_skeleton(inchikey: str) -> str:
+    """First block of a standard InChIKey, or None for anything else"""
+    if isinstance(inchikey, str) and len(inchikey) == 27 and inchikey[SKELETON_LENGTH] == '-':
+        return inchikey[:SKELETON_LENGTH]
+    return None
+
+
+class ClassificationCache:
+    """Persistent SQLite cache of ClassyFire responses keyed by InChIKey
+    
+    A response of {} records that ClassyFire has no entity for the key, so
+    it is not re-queried until the entry expires.
+    """
+    
+    def __init__(self, path: str, ttl_days: float = None, max_entries: int = None):
+        self.path = path
+        self.ttl = ttl_days * 86400 if ttl_days else None
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._accessed = {}  # InChIKey -> access time not yet written, see flush()
+        
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=SQLITE_TIMEOUT, check_same_thread=False)
+        # Readers never wait for a writer, so processes sharing the cache only queue their writes
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS classification ('
+            'inchikey TEXT PRIMARY KEY, '
+            'response TEXT NOT NULL, '
+            'created REAL NOT NULL, '
+            'accessed REAL NOT NULL, '
+            'skeleton TEXT)'
+        )
+        # Caches created before skeleton lookups get the column backfilled
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(classification)')]
+        if 'skeleton' not in columns:
+            self._conn.execute('ALTER TABLE classification ADD COLUMN skeleton TEXT')
+            self._conn.execute(
+                'UPDATE classification SET skeleton = substr(inchikey, 1, ?) '
+                "WHERE length(inchikey) = 27 AND substr(inchikey, ?, 1) = '-'",
+                (SKELETON_LENGTH, SKELETON_LENGTH + 1)
+            )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_classification_accessed '
+            'ON classification (accessed)'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_classification_skeleton '
+            'ON classification (skeleton)'
+        )
+        self._conn.commit()
+    
+    def get(self, inchikey: str) -> dict:
+        """Return the cached response for an InChIKey, or None on a miss"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT response, created FROM classification WHERE inchikey = ?',
+                (inchikey,)
+            ).fetchone()
+            
+            if row is None or (self.ttl and now - row[1] > self.ttl):
+                self.misses += 1
+                current_metrics().count('classification_cache_misses')
+                return None
+            
+            # Lookups stay read-only; access times are written in one batch by flush()
+            self._accessed[inchikey] = now
+            self.hits += 1
+        current_metrics().count('classification_cache_hits')
+        return json.loads(row[0])
+    
+    def get_skeleton(self, skeleton: str) -> tuple:
+        """Return (InChIKey, response) of an unexpired entry with this first block, or None"""
+        oldest = time.time() - self.ttl if self.ttl else 0
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT inchikey, response FROM classification '
+                "WHERE skeleton = ? AND created >= ? AND response != '{}' "
+                'ORDER BY inchikey LIMIT 1',
+                (skeleton, oldest)
+            ).fetchone()
+        return (row[0], json.loads(row[1])) if row is not None else None
+    
+    def put(self, inchikey: str, response: dict):
+        """Store a ClassyFire response for an InChIKey"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO classification '
+                '(inchikey, response, created, accessed, skeleton) VALUES (?, ?, ?, ?, ?)',
+                (inchikey, json.dumps(response), now, now, inchikey_skeleton(inchikey))
+            )
+            self._conn.commit()
+    
+    def flush(self):
+        """Record access times, drop expired entries and evict least recently used ones over the size limit"""
+        with self._lock:
+            if self._accessed:
+                self._conn.executemany(
+                    'UPDATE classification SET accessed = ? WHERE inchikey = ?',
+                    [(accessed, inchikey) for inchikey, accessed in self._accessed.items()]
+                )
+                self._accessed = {}
+            if self.ttl:
+                self._conn.execute(
+                    'DELETE FROM classification WHERE created < ?',
+                    (time.time() - self.ttl,)
+                )
+            if self.max_entries:
+                self._conn.execute(
+                    'DELETE FROM classification WHERE inchikey IN ('
+                    'SELECT inchikey FROM classification '
+                    'ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,)
+                )
+            self._conn.commit()
+    
+    def stats(self) -> dict:
+        """Return hit/miss counters for this session"""
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+
+class ConversionCache:
+    """Persistent SQLite cache of CTS conversions keyed by (source, target, identifier)
+    
+    A value of '' records that CTS has no match, so misses are not re-queried.
+    """
+    
+    QUERY_BATCH = 500  # identifiers per SELECT, below SQLite's parameter limit
+    
+    def __init__(self, path: str, ttl_days: float = None):
+        self.path = path
+        self.ttl = ttl_days * 86400 if ttl_days else None
+        self.hits = 0
+        self.misses = 0
+        
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=SQLITE_TIMEOUT, check_same_thread=False)
+        # Readers never wait for a writer, so processes sharing the cache only queue their writes
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS conversion ('
+            'source TEXT NOT NULL, '
+            'target TEXT NOT NULL, '
+            'identifier TEXT NOT NULL, '
+            'value TEXT NOT NULL, '
+            'created REAL NOT NULL, '
+            'PRIMARY KEY (source, target, identifier))'
+        )
+        self._conn.commit()
+    
+    def get_many(self, source: str, target: str, identifiers: list) -> dict:
+        """Return cached values for the identifiers that have one"""
+        found = {}
+        oldest = time.time() - self.ttl if self.ttl else 0
+        with self._lock:
+            for start in range(0, len(identifiers), self.QUERY_BATCH):
+                batch = identifiers[start:start + self.QUERY_BATCH]
+                placeholders = ', '.join('?' * len(batch))
+                rows = self._conn.execute(
+                    'SELECT identifier, value FROM conversion '
+                    'WHERE source = ? AND target = ? AND created >= ? '
+                    f'AND identifier IN ({placeholders})',
+                    (source, target, oldest, *batch)
+                )
+                found.update(rows)
+        
+        self.hits += len(found)
+        self.misses += len(identifiers) - len(found)
+        current_metrics().count('conversion_cache_hits', len(found))
+        current_metrics().count('conversion_cache_misses', len(identifiers) - len(found))
+        return found
+    
+    def put_many(self, source: str, target: str, values: dict):
+        """Store converted values, '' meaning no match"""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO conversion VALUES (?, ?, ?, ?, ?)',
+                [(source, target, identifier, value, now) for identifier, value in values.items()]
+            )
+            self._conn.commit()
+    
+    def stats(self) -> dict:
+        """Return hit/miss counters for this session"""
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+
+# ================== SNAPSHOT INDEX ==================
+SNAPSHOT_LEVELS = ['kingdom', 'superclass', 'class', 'subclass', 'direct_parent']
+
+
+class SnapshotIndex:
+    """
+    Read-only, memory-mapped index of ClassyFire responses sorted by InChIKey
+    
+    File layout: an 8-byte magic and the entry count, the sorted fixed-width
+    keys, count + 1 offsets into the data block, then the compact JSON
+    responses back to back. Lookups are a binary search over the mapped keys,
+    so opening the index costs nothing and nothing is loaded into memory.
+    """
+    
+    MAGIC = b'CFSNAP01'
+    KEY_WIDTH = 27  # length of a standard InChIKey
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = struct.unpack_from('<8sQ', self._mm, 0)
+        if magic != self.MAGIC:
+            self.close()
+            raise ValueError(f"Not a ClassyFire snapshot index: {path}")
+        
+        keys_start = 16
+        offsets_start = self._align(keys_start + self.count * self.KEY_WIDTH)
+        self._data_start = offsets_start + (self.count + 1) * 8
+        self._keys = np.frombuffer(self._mm, dtype=f'S{self.KEY_WIDTH}',
+                                   count=self.count, offset=keys_start)
+        self._offsets = np.frombuffer(self._mm, dtype='<u8',
+                                      count=self.count + 1, offset=offsets_start)
+    
+    @classmethod
+    def open(cls, path: str):
+        """Open the index at path, or return None if there is none"""
+        return cls(path) if path and os.path.exists(path) else None
+    
+    @staticmethod
+    def _align(position: int) -> int:
+        return (position + 7) // 8 * 8
+    
+    def __len__(self) -> int:
+        return self.count
+    
+    def get(self, inchikey: str) -> dict:
+        """Return the response stored for an InChIKey, or None"""
+        try:
+            key = inchikey.encode('ascii')
+        except (AttributeError, UnicodeEncodeError):
+            return None
+        if len(key) > self.KEY_WIDTH:
+            return None
+        
+        index = int(np.searchsorted(self._keys, key))
+        if index >= self.count or self._keys[index] != key:
+            current_metrics().count('snapshot_misses')
+            return None
+        current_metrics().count('snapshot_hits')
+        return self._entry(index)
+    
+    def find_skeleton(self, skeleton: str) -> tuple:
+        """Return (InChIKey, response) of the first entry with this first block, or None"""
+        prefix = skeleton.encode('ascii')
+        # The bare prefix sorts directly before every key that starts with it
+        index = int(np.searchsorted(self._keys, prefix))
+        if index >= self.count or not self._keys[index].startswith(prefix):
+            return None
+        return self._keys[index].decode('ascii'), self._entry(index)
+    
+    def _entry(self, index: int) -> dict:
+        start = self._data_start + int(self._offsets[index])
+        end = self._data_start + int(self._offsets[index + 1])
+        return json.loads(self._mm[start:end])
+    
+    def close(self):
+        # Arrays viewing the map must be released before it can be closed
+        self._keys = self._offsets = None
+        self._mm.close()
+        self._file.close()
+    
+    @classmethod
+    def write(cls, entries: dict, path: str) -> int:
+        """
+        Write an index file from InChIKey -> response pairs
+        
+        Args:
+            entries: Responses keyed by InChIKey; keys longer than KEY_WIDTH are skipped
+            path: Index file to create or replace
+            
+        Returns:
+            Number of entries written
+        """
+        keys = sorted(
+            key for key in entries
+            if isinstance(key, str) and key.isascii() and len(key) <= cls.KEY_WIDTH
+        )
+        blobs = [json.dumps(entries[key], separators=(',', ':')).encode('utf-8') for key in keys]
+        offsets = np.zeros(len(blobs) + 1, dtype='<u8')
+        offsets[1:] = np.cumsum([len(blob) for blob in blobs], dtype='<u8')
+        
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        keys_end = 16 + len(keys) * cls.KEY_WIDTH
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(struct.pack('<8sQ', cls.MAGIC, len(keys)))
+            f.write(np.array(keys, dtype=f'S{cls.KEY_WIDTH}').tobytes())
+            f.write(b'\0' * (cls._align(keys_end) - keys_end))
+            f.write(offsets.tobytes())
+            for blob in blobs:
+                f.write(blob)
+        os.replace(temp_path, path)
+        return len(keys)
+
+
+def _strip_inchikey(value) -> str:
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    return value[len('InChIKey='):] if value.startswith('InChIKey=') else value or None
+
+
+def read_classification_dump(path: str) -> dict:
+    """
+    Read a ClassyFire/ChemOnt classification dump into InChIKey -> response pairs
+    
+    Args:
+        path: JSON Lines or JSON list of ClassyFire entity responses, or any
+            table load_table accepts with an InChIKey column and kingdom,
+            superclass, class, subclass, direct_parent (and optionally
+            intermediate_nodes, '; '-separated) name columns
+            
+    Returns:
+        Responses in the shape of the ClassyFire entity endpoint
+    """
+    entries = {}
+    if path.endswith(('.jsonl', '.ndjson', '.json')):
+        with open(path, encoding='utf-8') as f:
+            if path.endswith('.json'):
+                records = json.load(f)
+            else:
+                records = (json.loads(line) for line in f if line.strip())
+            for record in records:
+                inchikey = _strip_inchikey(record.get('inchikey'))
+                if inchikey:
+                    entries[inchikey] = record
+        return entries
+    
+    df = load_table(path)
+    columns = {name.lower().replace(' ', '_'): name for name in df.columns}
+    if 'inchikey' not in columns:
+        raise ValueError(f"No InChIKey column in classification dump: {path}")
+    for row in df.to_dict('records'):
+        inchikey = _strip_inchikey(row[columns['inchikey']])
+        if not inchikey:
+            continue
+        record = {}
+        for level in SNAPSHOT_LEVELS:
+            name = row.get(columns.get(level))
+            record[level] = {'name': name} if isinstance(name, str) and name else None
+        nodes = row.get(columns.get('intermediate_nodes'))
+        record['intermediate_nodes'] = [
+            {'name': name.strip()} for name in nodes.split(';') if name.strip()
+        ] if isinstance(nodes, str) else []
+        entries[inchikey] = record
+    return entries
+
+
+def build_snapshot_index(dump_paths: list, index_path: str) -> int:
+    """Import one or more classification dumps into a snapshot index, later files winning"""
+    entries = {}
+    for dump_path in dump_paths:
+        entries.update(read_classification_dump(dump_path))
+        print(f"Read {dump_path}: {len(entries)} InChIKeys so far")
+    count = SnapshotIndex.write(entries, index_path)
+    print(f"Snapshot index with {count} InChIKeys written to {index_path}")
+    return count
+
+
+# ================== CHECKPOINT JOURNAL ==================
+class ClassificationJournal:
+    """Append-only JSONL journal of InChIKeys classified during an unfinished step 1"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+    
+    def load(self) -> dict:
+        """Return the classifications recorded by an interrupted run"""
+        completed = {}
+        if not os.path.exists(self.path):
+            return completed
+        
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A crash can leave a partially written last line
+                    continue
+                completed[entry['inchikey']] = entry['response']
+        return completed
+    
+    def append(self, inchikey: str, response: dict):
+        """Record a finished classification and flush it to disk"""
+        with self._lock:
+            if self._file is None:
+                folder = os.path.dirname(self.path)
+                if folder and not os.path.exists(folder):
+                    os.makedirs(folder)
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(json.dumps({'inchikey': inchikey, 'response': response}) + '\n')
+            self._file.flush()
+    
+    def clear(self):
+        """Remove the journal once the step has completed"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+# ================== INCREMENTAL MANIFEST ==================
+class PipelineManifest:
+    """
+    JSON manifest of content hashes recorded per step and per input file
+    
+    Each entry stores the fingerprint of the inputs a step consumed for one
+    file and the outputs it produced, so unchanged files can be skipped on
+    the next run.
+    """
+    
+    HASH_CHUNK_SIZE = 1 << 20
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.steps = {}
+        self._hashes = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.steps = json.load(f)
+    
+    def hash_file(self, path: str) -> str:
+        """Return the SHA-256 of a file's content, memoized by size and mtime"""
+        stat = os.stat(path)
+        memo_key = (path, stat.st_size, stat.st_mtime_ns)
+        if memo_key not in self._hashes:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            self._hashes[memo_key] = digest.hexdigest()
+        return self._hashes[memo_key]
+    
+    def fingerprint(self, *paths: str) -> str:
+        """Combine the names and content hashes of several files into one fingerprint"""
+        digest = hashlib.sha256()
+        for path in paths:
+            digest.update(os.path.basename(path).encode('utf-8'))
+            digest.update(self.hash_file(path).encode('ascii'))
+        return digest.hexdigest()
+    
+    def is_current(self, step: int, key: str, fingerprint: str) -> bool:
+        """Whether the recorded outputs for this key are still valid"""
+        entry = self.steps.get(str(step), {}).get(key)
+        return (
+            entry is not None
+            and entry['fingerprint'] == fingerprint
+            and all(os.path.exists(path) for path in entry['outputs'])
+        )
+    
+    def outputs(self, step: int, key: str) -> list:
+        """Return the outputs previously recorded for this key"""
+        return self.steps.get(str(step), {}).get(key, {}).get('outputs', [])
+    
+    def record(self, step: int, key: str, fingerprint: str, outputs: list):
+        """Record the fingerprint and outputs of a finished unit of work"""
+        self.steps.setdefault(str(step), {})[key] = {
+            'fingerprint': fingerprint,
+            'outputs': list(outputs)
+        }
+    
+    def discard(self, step: int, key: str):
+        """Forget a key and delete the outputs recorded for it"""
+        entry = self.steps.get(str(step), {}).pop(key, None)
+        for path in (entry or {}).get('outputs', []):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def prune(self, step: int, keys: list):
+        """Discard every key of a step whose input no longer exists"""
+        for key in set(self.steps.get(str(step), {})) - set(keys):
+            self.discard(step, key)
+    
+    def save(self):
+        """Write the manifest to disk atomically"""
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.steps, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+# ================== PROGRESS EVENTS ==================
+class ProgressReporter:
+    """
+    Thread-safe source of structured progress events
+    
+    Each event is a dict with the step number, the stage within the step,
+    items done and total, the current item, the rate in items per second,
+    the ETA in seconds (None while unknown), the elapsed seconds and an
+    optional message. Events go to the callback, which may be any callable
+    such as queue.Queue.put; without one they are dropped.
+    """
+    
+    def __init__(self, callback=None, min_interval: float = 0.2):
+        self.callback = callback
+        self.min_interval = min_interval  # seconds between events within a stage
+        self.step = None
+        self.stage = None
+        self.total = 0
+        self.done = 0
+        self._started = time.monotonic()
+        self._emitted = 0.0
+        self._lock = threading.Lock()
+    
+    def begin(self, step: int, stage: str, total: int, message: str = None):
+        """Start a new stage of total items"""
+        with self._lock:
+            self.step, self.stage = step, stage
+            self.total, self.done = total, 0
+            self._started = time.monotonic()
+            self._emit(None, message)
+    
+    def advance(self, count: int = 1, item: str = None):
+        """Mark count more items of the current stage as done"""
+        with self._lock:
+            self.done += count
+            now = time.monotonic()
+            if self.done >= self.total or now - self._emitted >= self.min_interval:
+                self._emit(item)
+    
+    def message(self, text: str):
+        """Send a free-form message within the current stage"""
+        with self._lock:
+            self._emit(None, text)
+    
+    def _emit(self, item: str = None, message: str = None):
+        if self.callback is None:
+            return
+        now = time.monotonic()
+        self._emitted = now
+        elapsed = now - self._started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate else None
+        self.callback({
+            'step': self.step,
+            'stage': self.stage,
+            'done': self.done,
+            'total': self.total,
+            'item': item,
+            'rate': rate,
+            'eta': eta,
+            'elapsed': elapsed,
+            'message': message
+        })
+
+
+def describe_progress(event: dict) -> str:
+    """Format a progress event as a single status line"""
+    text = f"Step {event['step']} - {event['stage']}: {event['done']}/{event['total']}"
+    if event['done'] and event['done'] < event['total']:
+        text += f" ({event['rate']:.1f}/s"
+        if event['eta'] is not None:
+            text += f", ETA {event['eta']:.0f}s"
+        text += ")"
+    if event['item']:
+        text += f" - {event['item']}"
+    if event['message']:
+        text += f" - {event['message']}"
+    return text
+
+
+# ================== RATE-LIMITED FETCHING ==================
+class TokenBucket:
+    """Thread-safe token-bucket rate limiter"""
+    
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.acquired = 0
+        self.waited = 0.0
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a token is available, then consume it"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self.rate:
+                    self._tokens = min(
+                        self.capacity,
+                        self._tokens + (now - self._updated) * self.rate
+                    )
+                self._updated = now
+                
+                if not self.rate or self._tokens >= 1:
+                    self._tokens -= 1 if self.rate else 0
+                    self.acquired += 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+                self.waited += wait
+            current_metrics().count('rate_limit_sleep_seconds', wait)
+            time.sleep(wait)
+
+
+class FetchEngine:
+    """Run lookups concurrently on a thread pool governed by a shared TokenBucket"""
+    
+    def __init__(self, fetch, limiter: TokenBucket, workers: int = 1):
+        self.fetch = fetch
+        self.limiter = limiter
+        self.workers = max(1, workers)
+        self.elapsed = 0.0
+        # Counted here rather than read from the limiter, which other pipelines may share
+        self.requests_made = 0
+    
+    @property
+    def achieved_rate(self) -> float:
+        """Requests per second actually sent while the engine was running"""
+        return self.requests_made / self.elapsed if self.elapsed else 0.0
+    
+    def run(self, keys: list):
+        """Fetch every key, yielding (key, result) pairs as they complete"""
+        if not keys:
+            return
+        
+        start = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                # Each fetch runs in a copy of this context so its counts reach the running pipeline
+                futures = {
+                    executor.submit(contextvars.copy_context().run, self.fetch, key): key
+                    for key in keys
+                }
+                for future in as_completed(futures):
+                    self.requests_made += 1
+                    yield futures[future], future.result()
+        finally:
+            self.elapsed += time.monotonic() - start
+
+
+# ================== PROCESS POOL ==================
+# Shared read-only state of a pool worker process, set once by _init_worker
+_worker_state = {}
+
+
+def _init_worker(state: dict):
+    """Install shared state in a pool worker"""
+    _worker_state.clear()
+    _worker_state.update(state)
+
+
+def _measured_task(task: tuple, state: dict = None) -> tuple:
+    """
+    Run func(item, state), returning its result with the time and counters it took
+    
+    Pool workers leave state out and use the one _init_worker installed.
+    """
+    func, item = task
+    metrics = current_metrics()
+    before = metrics.snapshot()
+    start = time.perf_counter()
+    result = func(item, _worker_state if state is None else state)
+    return result, time.perf_counter() - start, counter_delta(before, metrics.snapshot())
+
+
+def _task_label(item) -> str:
+    path = item[0] if isinstance(item, tuple) else item
+    return os.path.basename(str(path))
+
+
+def map_in_pool(func, items: list, workers: int = 1, state: dict = None,
+                on_result=None) -> list:
+    """
+    Apply a module-level function to every item, in worker processes when workers > 1
+    
+    Args:
+        func: Picklable function taking an item and the shared state
+        items: Work items
+        workers: Maximum number of worker processes
+        state: Read-only data passed to func with every item
+        on_result: Optional callable receiving (item, result) as each item finishes
+        
+    Returns:
+        Results in the same order as items
+    """
+    state = state or {}
+    on_result = on_result or (lambda item, result: None)
+    metrics = current_metrics()
+    if workers <= 1 or len(items) <= 1:
+        # State goes straight to the task, so concurrent pipelines in this process never share it
+        results = []
+        for item in items:
+            result, seconds, counters = _measured_task((func, item), state)
+            metrics.add_file(func.__name__.lstrip('_'), _task_label(item), seconds, counters)
+            results.append(result)
+            on_result(item, result)
+        return results
+    
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(items)),
+        initializer=_init_worker,
+        initargs=(state,)
+    ) as executor:
+        futures = [executor.submit(_measured_task, (func, item)) for item in items]
+        pending = {future: item for future, item in zip(futures, items)}
+        for future in as_completed(pending):
+            item = pending[future]
+            result, seconds, counters = future.result()
+            # Counters from worker processes are merged into the running pipeline's totals
+            metrics.merge(counters)
+            metrics.add_file(func.__name__.lstrip('_'), _task_label(item), seconds, counters)
+            on_result(item, result)
+        return [future.result()[0] for future in futures]
+
+
+# ================== CHEMONT TAXONOMY ==================
+def _is_name(value) -> bool:
+    return isinstance(value, str) and value != ''
+
+
+class ChemOntTaxonomy:
+    """
+    Interned ChemOnt nodes with integer IDs, parent pointers and ancestor arrays
+    
+    Node 0 is the root. Every (parent, name) pair is interned once and keeps
+    the rank of the level it came from. A classification is stored as the
+    ID of its direct parent node, and its level at any rank is found by
+    walking that node's ancestor array. Names are only produced when results
+    are exported.
+    """
+    
+    RANKS = ('kingdom', 'superclass', 'class', 'subclass')
+    ROOT = 0
+    NONE = -1  # classification without any known node
+    
+    def __init__(self):
+        self.names = ['ChemOnt']
+        self.parents = [-1]
+        self.ranks = [None]
+        self.ancestors = [np.zeros(0, dtype=np.int32)]  # path from kingdom down to the node itself
+        self._index = {}
+        self._class_lists = {self.NONE: []}
+        self._descriptions = {}
+    
+    def __len__(self) -> int:
+        return len(self.names)
+    
+    def intern(self, name: str, parent: int = ROOT, rank: str = None) -> int:
+        """Return the ID of a class name under parent, adding it if it is new"""
+        node = self._index.get((parent, name))
+        if node is None:
+            node = len(self.names)
+            self._index[(parent, name)] = node
+            self.names.append(name)
+            self.parents.append(parent)
+            self.ranks.append(rank)
+            self.ancestors.append(np.append(self.ancestors[parent], np.int32(node)))
+        return node
+    
+    def add_lineage(self, kingdom: str, superclass: str, class_: str, subclass: str,
+                    intermediate_nodes: list, direct_parent: str) -> int:
+        """Intern a classification's lineage and return the ID of its direct parent node"""
+        node = self.ROOT
+        for rank, name in zip(self.RANKS, (kingdom, superclass, class_, subclass)):
+            if _is_name(name):
+                node = self.intern(name, node, rank)
+        for name in intermediate_nodes:
+            if _is_name(name):
+                node = self.intern(name, node)
+        if node == self.ROOT and not _is_name(direct_parent):
+            return self.NONE
+        # A lineage without a direct parent ends in an unnamed placeholder node
+        return self.intern(direct_parent if _is_name(direct_parent) else None, node)
+    
+    def add_response(self, res: dict) -> int:
+        """Intern the lineage of a ClassyFire entity response"""
+        def name(level):
+            return (res.get(level) or {}).get('name')
+        
+        return self.add_lineage(
+            name('kingdom'), name('superclass'), name('class'), name('subclass'),
+            [node.get('name') for node in res.get('intermediate_nodes') or []],
+            name('direct_parent')
+        )
+    
+    def rank_node(self, node: int, rank: str) -> int:
+        """ID of the node's ancestor at a rank, or NONE"""
+        if node == self.NONE:
+            return self.NONE
+        for ancestor in self.ancestors[node]:
+            if self.ranks[ancestor] == rank:
+                return int(ancestor)
+        return self.NONE
+    
+    def describe(self, node: int) -> dict:
+        """Names of every level of a classification, '' where a level is missing"""
+        description = self._descriptions.get(node)
+        if description is None:
+            path = self.ancestors[node] if node != self.NONE else []
+            description = {rank: '' for rank in self.RANKS}
+            for ancestor in path:
+                if self.ranks[ancestor] is not None:
+                    description[self.ranks[ancestor]] = self.names[ancestor]
+            description['direct_parent'] = (self.names[node] or '') if node != self.NONE else ''
+            description['intermediate_nodes'] = '; '.join(
+                self.names[ancestor] for ancestor in path[:-1] if self.ranks[ancestor] is None
+            )
+            self._descriptions[node] = description
+        return description
+    
+    def class_list(self, node: int) -> list:
+        """Class column value: direct parent, then kingdom down to subclass; shared per node"""
+        class_list = self._class_lists.get(node)
+        if class_list is None:
+            class_list = [self.names[node]] if self.names[node] is not None else []
+            class_list += [
+                self.names[ancestor] for ancestor in self.ancestors[node]
+                if self.ranks[ancestor] is not None
+            ]
+            self._class_lists[node] = class_list
+        return class_list
+    
+    def class_lists(self, nodes: pd.Series) -> pd.Series:
+        """Expand a Series of node IDs into Class lists, leaving NaN for unknown keys"""
+        return nodes.map(
+            lambda node: self.class_list(int(node)) if pd.notna(node) else np.nan
+        ).astype(object)
+
+
+def grouping_result_files(folder: str) -> list:
+    """Paths of every grouping result written by step 1, in a stable order"""
+    paths = []
+    for root, dirs, files in os.walk(folder):
+        for file in sorted(files):
+            if file.endswith(INTERMEDIATE_EXTENSIONS):
+                paths.append(os.path.join(root, file))
+    return paths
+
+
+def load_grouping_results(folder: str) -> pd.DataFrame:
+    """Concatenate every grouping result written by step 1, or None if there are none"""
+    frames = [load_table(path) for path in grouping_result_files(folder)]
+    return pd.concat(frames, ignore_index=True) if frames else None
+
+
+def build_class_lookup(grouping_df: pd.DataFrame, key: str) -> tuple:
+    """
+    Intern the classifications of grouping rows into a taxonomy
+    
+    Args:
+        grouping_df: Grouping results, as returned by load_grouping_results
+        key: Column identifying a compound ('inchikey' or 'title'); the first
+            row of each key wins
+        
+    Returns:
+        (ChemOntTaxonomy, Series mapping each key to its node, NONE when unclassified)
+    """
+    taxonomy = ChemOntTaxonomy()
+    if grouping_df is None:
+        return taxonomy, pd.Series(dtype='int64')
+    
+    src_df = grouping_df[grouping_df[key].notna()].drop_duplicates(key, keep="first")
+    lineage_df = src_df.reindex(
+        columns=["Kingdom", "Superclass", "class", "subclass", "intermediate_nodes", "direct_parents"]
+    )
+    # Missing levels become '' so equal lineages are equal dictionary keys (NaN never is)
+    lineage_df = lineage_df.astype(object).where(lineage_df.notna(), '')
+    
+    # Far fewer distinct lineages than compounds, so each is interned once
+    lineage_nodes = {}
+    nodes = []
+    for lineage in lineage_df.itertuples(index=False, name=None):
+        node = lineage_nodes.get(lineage)
+        if node is None:
+            kingdom, superclass, class_, subclass, intermediate_nodes, direct_parent = lineage
+            node = lineage_nodes[lineage] = taxonomy.add_lineage(
+                kingdom, superclass, class_, subclass,
+                intermediate_nodes.split('; ') if _is_name(intermediate_nodes) else [],
+                direct_parent
+            )
+        nodes.append(node)
+    return taxonomy, pd.Series(nodes, index=src_df[key].to_numpy(), dtype='int64')
 
 
 # ================== STEP 1: CHEMICAL CLASSIFICATION ==================
 class ChemicalClassifier:
     """Handle chemical classification using ClassyFire API"""
     
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, session: requests.Session = None,
+                 manifest: PipelineManifest = None, progress: ProgressReporter = None,
+                 limiter: TokenBucket = None):
         self.config = config
         self.site = config.CLASSYFIRE_SITE
+        self.manifest = manifest
+        self.progress = progress or ProgressReporter()
+        self.format = resolve_intermediate_format(config)
+        self.session = session or create_http_session(config)
+        self.cache = None
+        if config.CACHE_ENABLED:
+            self.cache = ClassificationCache(
+                config.CACHE_PATH,
+                ttl_days=config.CACHE_TTL_DAYS,
+                max_entries=config.CACHE_MAX_ENTRIES
+            )
+        self.snapshot = SnapshotIndex.open(config.SNAPSHOT_PATH)
+        self.skeleton_matches = {}  # InChIKey -> InChIKey of the entry it was resolved from
+        self.taxonomy = ChemOntTaxonomy()
+        self.nodes = {}  # InChIKey -> taxonomy node of its classification
+        if self.snapshot is not None:
+            print(f"Using ClassyFire snapshot index with {len(self.snapshot)} InChIKeys")
+        # A limiter passed in is shared with other pipelines calling ClassyFire
+        self.limiter = limiter or TokenBucket(config.API_RATE_LIMIT, config.API_BURST)
+        self.engine = FetchEngine(self._fetch_entity, self.limiter, config.FETCH_WORKERS)
+        self.journal = ClassificationJournal(
+            os.path.join(config.CHECKPOINT_FOLDER, config.CLASSIFICATION_JOURNAL)
+        )
         
     def get_classification(self, inchikey: str, format: str = 'json') -> dict:
         """
-        Get chemical classification from ClassyFire API
+        Get chemical classification, from the local cache or snapshot index if possible
         
         Args:
             inchikey: InChI key for the chemical
@@ -61,58 +1510,331 @@ class ChemicalClassifier:
         Returns:
             Dictionary containing classification data
         """
+        if format == 'json':
+            local = self._lookup_local(inchikey)
+            if local is not None:
+                return local
+        return self._fetch_entity(inchikey, format) or {}
+    
+    def _lookup_local(self, inchikey: str) -> dict:
+        """Answer from the cache, then the snapshot index; None if neither knows the key"""
+        cached = self.cache.get(inchikey) if self.cache is not None else None
+        if not cached and self.snapshot is not None:
+            # A snapshot entry also beats a cached "ClassyFire has no entity"
+            snapshot = self.snapshot.get(inchikey)
+            if snapshot is not None:
+                cached = snapshot
+        return cached
+    
+    def _fetch_entity(self, inchikey: str, format: str = 'json') -> dict:
+        """Fetch an entity, returning {} if ClassyFire has none and None on transient errors"""
         url = f'{self.site}/entities/{inchikey}.{format}'
         headers = {'Accept': f'application/{format}'}
         
-        for attempt in range(self.config.REQUEST_RETRIES):
-            try:
-                response = requests.get(
-                    url, 
-                    headers=headers, 
-                    timeout=self.config.REQUEST_TIMEOUT
-                )
-                response.raise_for_status()
-                return response.json()
+        # Retries and backoff are handled by the session's transport adapter
+        self.limiter.acquire()
+        try:
+            response = self.session.get(
+                url, 
+                headers=headers, 
+                timeout=self.config.REQUEST_TIMEOUT
+            )
+            current_metrics().count('classyfire_requests')
+            current_metrics().count('retries', _retry_count(response))
+            response.raise_for_status()
+            return response.json()
+            
+        except HTTPError as http_err:
+            print(f"HTTP error occurred: {http_err}")
+            return {} if response.status_code == 404 else None
                 
-            except HTTPError as http_err:
-                if response.status_code in [404, 500, 504, 408]:
-                    print(f"HTTP error occurred: {http_err}")
-                    return {}
-                else:
-                    print(f"HTTP error occurred: {http_err}")
-                    return {}
-                    
-            except RequestException as req_err:
-                print(f'Request error occurred: {req_err}')
-                if attempt < self.config.REQUEST_RETRIES - 1:
-                    time.sleep(self.config.BACKOFF_FACTOR * (2 ** attempt))
-                else:
-                    return {}
+        except RequestException as req_err:
+            print(f'Request error occurred: {req_err}')
+            return None
+    
+    def classify_inchikeys(self, inchikeys: list, smiles: dict = None) -> dict:
+        """
+        Get chemical classifications for many InChIKeys at once
+        
+        Keys finished by an interrupted run, present in the cache or in the
+        snapshot index are answered locally. In bulk mode, the rest are submitted as batch
+        structure queries first. Whatever is still missing is fetched per
+        entity, concurrently under the shared rate limit. Results are
+        journaled as they arrive. Keys ClassyFire has no entity for may then
+        be resolved from a local stereoisomer (SKELETON_MATCH).
+        
+        Args:
+            inchikeys: InChI keys to classify (duplicates and non-strings are ignored)
+            smiles: Optional InChIKey -> SMILES mapping used by bulk mode
+            
+        Returns:
+            Dictionary mapping each InChIKey to its classification data
+        """
+        completed = self.journal.load()
+        if completed:
+            print(f"Resuming classification: {len(completed)} InChIKeys already completed")
+        
+        results = {}
+        pending = []
+        not_found = []  # keys ClassyFire answered 404 for
+        for inchikey in dict.fromkeys(k for k in inchikeys if isinstance(k, str)):
+            if inchikey in completed:
+                results[inchikey] = completed[inchikey]
+                if not completed[inchikey]:
+                    not_found.append(inchikey)
+                continue
+            cached = self._lookup_local(inchikey)
+            if cached is not None:
+                results[inchikey] = cached
+                if not cached:
+                    not_found.append(inchikey)
+            else:
+                pending.append(inchikey)
+        
+        self.progress.begin(1, 'classify', len(results) + len(pending))
+        self.progress.advance(len(results))
+        
+        if self.config.CLASSYFIRE_BULK and smiles:
+            structures = {k: smiles[k] for k in pending if isinstance(smiles.get(k), str) and smiles[k]}
+            for inchikey, res in self._bulk_classify(structures):
+                self._record_classification(results, inchikey, res)
+            pending = [k for k in pending if k not in results]
+            if structures:
+                classified = sum(k in results for k in structures)
+                print(f"Bulk queries classified {classified} of {len(structures)} structures; "
+                      f"{len(pending)} InChIKeys left for per-entity lookups")
+        
+        for inchikey, res in self.engine.run(pending):
+            self._record_classification(results, inchikey, res)
+            if res == {}:
+                not_found.append(inchikey)
+        
+        # Only keys without an exact entity fall back to a known stereoisomer,
+        # which may also be one fetched during this run
+        if self.config.SKELETON_MATCH:
+            self._match_skeletons(not_found, results)
+        
+        return results
+    
+    def _match_skeletons(self, inchikeys: list, results: dict) -> list:
+        """
+        Resolve keys without a ClassyFire entity from local entries sharing their first block
+        
+        Matches are flagged in skeleton_matches and are neither journaled
+        nor cached, so later runs still ask ClassyFire for the exact key first.
+        
+        Returns:
+            Keys that found no match
+        """
+        unmatched = []
+        for inchikey in inchikeys:
+            skeleton = inchikey_skeleton(inchikey)
+            match = None
+            if skeleton is not None and self.cache is not None:
+                match = self.cache.get_skeleton(skeleton)
+            if match is None and skeleton is not None and self.snapshot is not None:
+                match = self.snapshot.find_skeleton(skeleton)
+            if match is None:
+                unmatched.append(inchikey)
+                continue
+            self.skeleton_matches[inchikey] = match[0]
+            results[inchikey] = match[1]
+            current_metrics().count('skeleton_matches')
+        return unmatched
+    
+    def _record_classification(self, results: dict, inchikey: str, res: dict):
+        """Store a fetched classification in the results, journal and cache"""
+        results[inchikey] = res or {}
+        self.progress.advance(item=inchikey)
+        if res is None:
+            return
+        self.journal.append(inchikey, res)
+        if self.cache is not None:
+            # {} is cached too, so keys ClassyFire lacks are not fetched again
+            self.cache.put(inchikey, res)
+    
+    def _bulk_classify(self, structures: dict):
+        """
+        Classify structures through ClassyFire batch queries
+        
+        All batches are submitted up front so ClassyFire computes them
+        together, then each query is polled with exponential backoff.
+        Compounds of failed, invalid or timed-out queries are simply not
+        yielded and fall back to per-entity lookups.
+        
+        Args:
+            structures: InChIKey -> SMILES of the compounds to classify
+            
+        Yields:
+            (InChIKey, classification) pairs as result pages arrive
+        """
+        items = list(structures.items())
+        size = max(1, self.config.BULK_BATCH_SIZE)
+        queries = []
+        for start in range(0, len(items), size):
+            query_id = self._submit_query(items[start:start + size])
+            if query_id is not None:
+                queries.append(query_id)
+        if queries:
+            print(f"Submitted {len(queries)} ClassyFire queries for {len(items)} structures")
+        
+        deadline = time.monotonic() + self.config.BULK_TIMEOUT
+        for query_id in queries:
+            for entity in self._collect_query(query_id, deadline):
+                # Each structure was submitted with its InChIKey as identifier
+                inchikey = entity.get('identifier')
+                if inchikey in structures:
+                    yield inchikey, entity
+    
+    def _submit_query(self, batch: list) -> int:
+        """Submit (InChIKey, SMILES) pairs as one structure query, returning its ID or None"""
+        payload = {
+            'label': 'NCKU_ClassyFire',
+            'query_input': '\n'.join(f"{inchikey}\t{smiles}" for inchikey, smiles in batch),
+            'query_type': 'STRUCTURE'
+        }
+        # POST is not retried by the transport, so a query is never submitted twice
+        self.limiter.acquire()
+        try:
+            response = self.session.post(
+                f'{self.site}/queries.json',
+                json=payload,
+                headers={'Accept': 'application/json'},
+                timeout=self.config.REQUEST_TIMEOUT
+            )
+            current_metrics().count('classyfire_queries_submitted')
+            response.raise_for_status()
+            return response.json()['id']
+        except (RequestException, ValueError, KeyError) as err:
+            print(f'ClassyFire query submission failed: {err}')
+            return None
+    
+    def _get_query_page(self, query_id: int, page: int) -> dict:
+        """Fetch one page of a query's status and results, or None on errors"""
+        self.limiter.acquire()
+        try:
+            response = self.session.get(
+                f'{self.site}/queries/{query_id}.json',
+                params={'page': page},
+                headers={'Accept': 'application/json'},
+                timeout=self.config.REQUEST_TIMEOUT
+            )
+            current_metrics().count('classyfire_requests')
+            current_metrics().count('retries', _retry_count(response))
+            response.raise_for_status()
+            return response.json()
+        except (RequestException, ValueError) as err:
+            print(f'ClassyFire query {query_id} request failed: {err}')
+            return None
+    
+    def _collect_query(self, query_id: int, deadline: float):
+        """Wait for a query to finish, then yield the entities of every result page"""
+        interval = self.config.BULK_POLL_INTERVAL
+        while True:
+            page = self._get_query_page(query_id, 1)
+            if page is None:
+                return
+            status = page.get('classification_status')
+            if status == 'Done':
+                break
+            if time.monotonic() + interval > deadline:
+                print(f'ClassyFire query {query_id} timed out ({status})')
+                return
+            self.progress.message(f'Waiting for ClassyFire query {query_id} ({status})')
+            current_metrics().count('bulk_poll_sleep_seconds', interval)
+            time.sleep(interval)
+            interval = min(interval * 2, self.config.BULK_POLL_MAX_INTERVAL)
+        
+        for number in range(1, (page.get('number_of_pages') or 1) + 1):
+            if number > 1:
+                page = self._get_query_page(query_id, number)
+                if page is None:
+                    return
+            yield from page.get('entities') or []
     
     def process_classification_files(self):
         """Process all Excel files in source folder for classification"""
         # Create output folder if it doesn't exist
         if not os.path.exists(self.config.GROUPING_FOLDER):
             os.makedirs(self.config.GROUPING_FOLDER)
-        
+
         # Get all Excel files
         src_files = [f for f in os.listdir(self.config.SOURCE_FOLDER) 
-                    if f.endswith(('.xlsx', '.csv', '.txt'))]
+                    if f.endswith(SOURCE_EXTENSIONS)]
+        
+        # Skip files whose content has not changed since their grouping result was written
+        fingerprints = {}
+        if self.manifest is not None:
+            self.manifest.prune(1, src_files)
+            fingerprints = {
+                f: self.manifest.fingerprint(os.path.join(self.config.SOURCE_FOLDER, f))
+                for f in src_files
+            }
+            src_files = [f for f in src_files if not self.manifest.is_current(1, f, fingerprints[f])]
+            print(f"Incremental mode: {len(src_files)} of {len(fingerprints)} files need classification")
+        
+        # Planning pass: classify every unique InChIKey across all files once.
+        # When streaming, only the keys are kept and files are read again below.
+        inputs = {}
+        inchikeys = {}
+        smiles = {}
+        row_count = 0
+        for file in src_files:
+            chunks = self._iter_classification_input(file)
+            if not self.config.CHUNK_SIZE:
+                chunks = inputs[file] = list(chunks)
+            for chunk in chunks:
+                row_count += len(chunk)
+                inchikeys.update(dict.fromkeys(chunk['InChIKey']))
+                if 'SMILES' in chunk.columns:
+                    structures = chunk.dropna(subset=['InChIKey', 'SMILES'])
+                    smiles.update(zip(structures['InChIKey'], structures['SMILES']))
+        unique_count = sum(isinstance(k, str) for k in inchikeys)
+        print(f"Classifying {unique_count} unique InChIKeys from {row_count} rows "
+              f"across {len(src_files)} files")
+        results = self.classify_inchikeys(list(inchikeys), smiles)
 
+        self.progress.begin(1, 'write', len(src_files))
         for file in src_files:
-            self._process_single_file(file)
+            chunks = inputs[file] if file in inputs else self._iter_classification_input(file)
+            with current_metrics().measure_file('classification_output', file):
+                output_path = self._process_single_file(file, chunks, results)
+            self.progress.advance(item=file)
+            if self.manifest is not None:
+                self.manifest.record(1, file, fingerprints[file], [output_path])
+        self.journal.clear()
+        if self.manifest is not None:
+            self.manifest.save()
+        
+        if self.cache is not None:
+            self.cache.flush()
+            stats = self.cache.stats()
+            print(f"Classification cache: {stats['hits']} hits, {stats['misses']} misses "
+                  f"({stats['hit_rate']:.1%} hit rate)")
+        print(f"ClassyFire requests: {self.engine.requests_made} in {self.engine.elapsed:.1f}s "
+              f"({self.engine.achieved_rate:.2f} req/s)")
     
-    def _process_single_file(self, filename: str):
-        """Process a single Excel file for classification"""
+    def _iter_classification_input(self, filename: str):
+        """Stream the Title/InChIKey rows of a single source table that need classification"""
         file_path = os.path.join(self.config.SOURCE_FOLDER, filename)
-        df = pd.read_excel(file_path)
-        # df = pd.read_csv(file_path,sep='\t')
-
-        # Filter rows where title is not unknown
-        if 'Title' not in df.columns and 'Name' in df.columns:
-            df.rename(columns={'Name': 'Title'}, inplace=True)
-        filtered_df = df[df['Title'] != 'Unknown']
-        
+        # Bulk mode also needs the structures MS-DIAL exports
+        columns = ['Title', 'InChIKey'] + (['SMILES'] if self.config.CLASSYFIRE_BULK else [])
+        for df in iter_table_chunks(file_path, columns, self.config.CHUNK_SIZE):
+            # Filter rows where title is not unknown
+            yield df.loc[df['Title'] != 'Unknown', [c for c in columns if c in df.columns]]
+    
+    def _process_single_file(self, filename: str, chunks, results: dict) -> str:
+        """Build the grouping result of a single file from pre-fetched classifications"""
+        output_file_path = None
+        for index, filtered_df in enumerate(chunks):
+            classification_data = self._build_classification_data(filtered_df, results)
+            output_file_path = self._save_classification_results(
+                classification_data, filename, append=index > 0
+            )
+        return output_file_path
+    
+    def _build_classification_data(self, filtered_df: pd.DataFrame, results: dict) -> dict:
+        """Build grouping columns for a chunk of rows from pre-fetched classifications"""
         # Initialize data containers
         classification_data = {
             'title': [],
@@ -122,7 +1844,8 @@ class ChemicalClassifier:
             'class': [],
             'subclass': [],
             'intermediate_nodes': [],
-            'direct_parents': []
+            'direct_parents': [],
+            'match_type': []
         }
         
         # Process each row
@@ -130,12 +1853,10 @@ class ChemicalClassifier:
             title = row['Title']
             inchikey = row['InChIKey']
             
-            # Get classification
-            res = self.get_classification(inchikey)
-            print(json.dumps(res, indent=4))
+            res = results.get(inchikey, {})
             
             # Extract classification data
-            classification_info = self._extract_classification_info(res)
+            classification_info = self._extract_classification_info(inchikey, res)
             
             # Append data
             classification_data['title'].append(title)
@@ -146,132 +1867,185 @@ class ChemicalClassifier:
             classification_data['subclass'].append(classification_info['subclass'])
             classification_data['intermediate_nodes'].append(classification_info['intermediate_nodes'])
             classification_data['direct_parents'].append(classification_info['direct_parent'])
-            
-            # Delay between API calls
-            time.sleep(self.config.API_DELAY)
+            if inchikey in self.skeleton_matches:
+                classification_data['match_type'].append('skeleton')
+            else:
+                classification_data['match_type'].append('exact' if res else 'none')
         
-        # Save results
-        self._save_classification_results(classification_data, filename)
+        return classification_data
     
-    def _extract_classification_info(self, res: dict) -> dict:
-        """Extract classification information from API response"""
-        kingdom = res.get('kingdom', {}).get('name', '') if res.get('kingdom') else ''
-        superclass = res.get('superclass', {}).get('name', '') if res.get('superclass') else ''
-        class_ = res.get('class', {}).get('name', '') if res.get('class') else ''
-        subclass = res.get('subclass', {}).get('name', '') if res.get('subclass') else ''
-        direct_parent = res.get('direct_parent', {}).get('name', '') if res.get('direct_parent') else ''
-        
-        intermediate_nodes = []
-        if 'intermediate_nodes' in res:
-            for node in res['intermediate_nodes']:
-                intermediate_nodes.append(node.get('name', ''))
-        
-        return {
-            'kingdom': kingdom,
-            'superclass': superclass,
-            'class': class_,
-            'subclass': subclass,
-            'direct_parent': direct_parent,
-            'intermediate_nodes': '; '.join(intermediate_nodes)
-        }
+    def _extract_classification_info(self, inchikey: str, res: dict) -> dict:
+        """Extract classification information from an API response through the taxonomy"""
+        if not isinstance(inchikey, str):
+            return self.taxonomy.describe(ChemOntTaxonomy.NONE)
+        node = self.nodes.get(inchikey)
+        if node is None:
+            node = self.nodes[inchikey] = self.taxonomy.add_response(res)
+        return self.taxonomy.describe(node)
     
-    def _save_classification_results(self, data: dict, filename: str):
+    def _save_classification_results(self, data: dict, filename: str, append: bool = False) -> str:
         """Save classification results to CSV file"""
         result_df = pd.DataFrame(data)
         output_file_path = os.path.join(
             self.config.GROUPING_FOLDER, 
-            filename.replace('.xlsx', '.csv')
+            intermediate_name(filename, self.format)
         )
-        result_df.to_csv(output_file_path, index=False)
-        print(f'Saved processed data to {output_file_path}')
+        write_intermediate(result_df, output_file_path, append=append)
+        if not append:
+            print(f'Saved processed data to {output_file_path}')
+        return output_file_path
 
 
 # ================== STEP 2: DATA MERGING ==================
+def _merge_source_file(task: tuple, state: dict) -> str:
+    """Pool task: add the Class column to one source table and write it"""
+    file_path, export_file_path = task
+    chunks = iter_table_chunks(file_path, chunksize=state["chunk_size"])
+    taxonomy = state["taxonomy"]
+    for index, target_df in enumerate(chunks):
+        # Add Class column from classification data, expanding node IDs to names on export
+        nodes = target_df["InChIKey"].map(state["class_lookup"])
+        target_df["Class"] = taxonomy.class_lists(nodes)
+        write_intermediate(target_df, export_file_path, append=index > 0)
+    return export_file_path
+
+
 class DataMerger:
     """Handle merging of classification data with original data"""
     
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, manifest: PipelineManifest = None,
+                 progress: ProgressReporter = None):
         self.config = config
+        self.manifest = manifest
+        self.progress = progress or ProgressReporter()
+        self.format = resolve_intermediate_format(config)
     
     def merge_classification_data(self):
         """Merge classification data with original Excel files"""
-        # Build InChIKey dictionary from classification results
-        inchikey_dict = self._build_inchikey_dictionary()
-        
         # Process original Excel files
-        self._process_original_files(inchikey_dict)
+        self._process_original_files()
     
-    def _build_inchikey_dictionary(self) -> dict:
-        """Build dictionary mapping InChIKey to classification data"""
-        inchikey_dict = {}
-        
-        for root, dirs, files in os.walk(self.config.GROUPING_FOLDER):
-            for file in files:
-                if file.endswith(('.csv', '.xlsx', '.txt')):
-                    file_path = os.path.join(root, file)
-                    src_df = pd.read_csv(file_path)
-                    
-                    for _, row in src_df.iterrows():
-                        inchikey = row["inchikey"]
-                        if inchikey not in inchikey_dict:
-                            inchikey_dict[inchikey] = []
-                        
-                        # Add classification levels if they exist
-                        for level in ["direct_parents", "Kingdom", "Superclass", "class", "subclass"]:
-                            if row[level]:
-                                inchikey_dict[inchikey].append(row[level])
-        
-        return inchikey_dict
-    
-    def _process_original_files(self, inchikey_dict: dict):
+    def _build_class_lookup(self) -> tuple:
+        """Build the taxonomy of all grouping results and a Series mapping InChIKey to its node"""
+        # Step 1 classifies each InChIKey once, so one grouping row per key is
+        # enough and keeps each file's Class lists independent of other files
+        return build_class_lookup(load_grouping_results(self.config.GROUPING_FOLDER), "inchikey")
+    
+    def _process_original_files(self):
         """Process original Excel files and add classification data"""
         # Create output folder
         if not os.path.exists(self.config.FINAL_RESULT_FOLDER):
             os.makedirs(self.config.FINAL_RESULT_FOLDER)
-        
+
+        src_files = []
         for root, dirs, files in os.walk(self.config.SOURCE_FOLDER):
             for file in files:
-                if file.endswith(('.xlsx', '.csv', '.txt')):
-                    file_path = os.path.join(root, file)
-                    target_df = pd.read_excel(file_path)
-                    
-                    # Add Class column
-                    target_df["Class"] = None
-                    
-                    # Fill classification data
-                    for index, row in target_df.iterrows():
-                        inchikey = row["InChIKey"]
-                        if inchikey and (inchikey in inchikey_dict):
-                            target_df.at[index, "Class"] = inchikey_dict[inchikey]
-                    
-                    # Save result
-                    self._save_merged_file(target_df, file)
-    
-    def _save_merged_file(self, df: pd.DataFrame, filename: str):
-        """Save merged data to CSV file with timestamp"""
+                if file.endswith(SOURCE_EXTENSIONS):
+                    src_files.append(os.path.join(root, file))
+        src_files.sort()
+        
+        # A merged file depends on its source table and its own grouping result
+        fingerprints = {}
+        if self.manifest is not None:
+            keys = [os.path.relpath(path, self.config.SOURCE_FOLDER) for path in src_files]
+            self.manifest.prune(2, keys)
+            for key, file_path in zip(keys, src_files):
+                grouping_path = os.path.join(
+                    self.config.GROUPING_FOLDER,
+                    intermediate_name(file_path, self.format)
+                )
+                inputs = [file_path] + ([grouping_path] if os.path.exists(grouping_path) else [])
+                fingerprints[file_path] = (key, self.manifest.fingerprint(*inputs))
+            src_files = [
+                path for path in src_files
+                if not self.manifest.is_current(2, *fingerprints[path])
+            ]
+            print(f"Incremental mode: {len(src_files)} of {len(keys)} files need merging")
+        
+        if not src_files:
+            return
+        
+        # Replace the outputs of the previous run
+        if self.manifest is not None:
+            for file_path in src_files:
+                self.manifest.discard(2, fingerprints[file_path][0])
+        
+        # Build InChIKey -> taxonomy node lookup from classification results
+        taxonomy, class_lookup = self._build_class_lookup()
+        
+        # Merge files in parallel; every file of a run shares one timestamp
         current_datetime = datetime.datetime.now()
-        base_filename = os.path.basename(filename)
-        if base_filename.endswith(('.xlsx', '.csv', '.txt')):
-            base_filename = base_filename[:-5]
+        tasks = [(path, self._merged_file_path(path, current_datetime)) for path in src_files]
+        self.progress.begin(2, 'merge', len(tasks))
+        output_paths = map_in_pool(
+            _merge_source_file, tasks,
+            workers=self.config.PROCESS_WORKERS,
+            state={"taxonomy": taxonomy, "class_lookup": class_lookup, "chunk_size": self.config.CHUNK_SIZE},
+            on_result=lambda task, path: self.progress.advance(item=os.path.basename(path))
+        )
         
-        formatted_datetime = current_datetime.strftime("%Y-%m-%d_%H-%M-%S")
-        export_file_name = f"{base_filename}_{formatted_datetime}.csv"
-        export_file_path = os.path.join(self.config.FINAL_RESULT_FOLDER, export_file_name)
+        for file_path, output_path in zip(src_files, output_paths):
+            print(f"The file saved at {output_path}")
+            if self.manifest is not None:
+                self.manifest.record(2, *fingerprints[file_path], [output_path])
+        
+        if self.manifest is not None:
+            self.manifest.save()
+    
+    def _merged_file_path(self, filename: str, current_datetime: datetime.datetime) -> str:
+        """Build the timestamped path for a merged file"""
+        base_filename = os.path.splitext(os.path.basename(filename))[0]
         
-        df.to_csv(export_file_path, index=False)
-        print(f"The file saved at {export_file_path}")
+        formatted_datetime = current_datetime.strftime("%Y-%m-%d_%H-%M-%S")
+        extension = '.parquet' if self.format == 'parquet' else '.csv'
+        export_file_name = f"{base_filename}_{formatted_datetime}{extension}"
+        return os.path.join(self.config.FINAL_RESULT_FOLDER, export_file_name)
 
 
 # ================== STEP 3: CHEMICAL CONVERSION ==================
+def _read_inchikeys(file_path: str, state: dict) -> list:
+    """Pool task: read the unique InChIKeys of a merged file"""
+    inchikeys = {}
+    for chunk in iter_table_chunks(file_path, ['InChIKey'], state.get("chunk_size")):
+        inchikeys.update(dict.fromkeys(chunk['InChIKey']))
+    return list(inchikeys)
+
+
+def _convert_merged_file(task: tuple, state: dict) -> str:
+    """Pool task: add converted identifier columns to one merged file and write it"""
+    file_path, export_file_path = task
+    chunks = iter_table_chunks(file_path, chunksize=state["chunk_size"])
+    for index, df in enumerate(chunks):
+        # Map results back to every matching row
+        for target, mapping in state["mappings"].items():
+            df[target] = df['InChIKey'].map(mapping).astype(object)
+        write_intermediate(df, export_file_path, append=index > 0)
+    return export_file_path
+
+
 class ChemicalConverter:
     """Handle chemical identifier conversion using CTS API"""
     
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, session: requests.Session = None,
+                 manifest: PipelineManifest = None, progress: ProgressReporter = None,
+                 limiter: TokenBucket = None):
         self.config = config
+        self.session = session or create_http_session(config)
+        self.manifest = manifest
+        self.progress = progress or ProgressReporter()
+        self.format = resolve_intermediate_format(config)
+        self.limiter = limiter or TokenBucket(config.CTS_RATE_LIMIT)
+        self.cache = None
+        if config.CACHE_ENABLED:
+            self.cache = ConversionCache(
+                config.CONVERSION_CACHE_PATH,
+                ttl_days=config.CONVERSION_CACHE_TTL_DAYS
+            )
     
     def convert_identifiers(self):
         """Convert InChIKey to other chemical identifiers"""
-        file_list = glob.glob(os.path.join(self.config.FINAL_RESULT_FOLDER, '*'))
+        file_list = sorted(glob.glob(os.path.join(self.config.FINAL_RESULT_FOLDER, '*')))
+        file_list = [path for path in file_list if path.endswith(INTERMEDIATE_EXTENSIONS)]
         
         if len(file_list) == 0:
             print('[ERROR] No files in the final_result folder to process')
@@ -281,107 +2055,216 @@ class ChemicalConverter:
         if not os.path.exists(self.config.CONVERT_RESULT_FOLDER):
             os.makedirs(self.config.CONVERT_RESULT_FOLDER)
         
-        for file_path in file_list:
-            self._convert_single_file(file_path)
+        # Skip merged files that were already converted
+        fingerprints = {}
+        if self.manifest is not None:
+            self.manifest.prune(3, [os.path.basename(path) for path in file_list])
+            fingerprints = {path: self.manifest.fingerprint(path) for path in file_list}
+            total = len(file_list)
+            file_list = [
+                path for path in file_list
+                if not self.manifest.is_current(3, os.path.basename(path), fingerprints[path])
+            ]
+            print(f"Incremental mode: {len(file_list)} of {total} files need conversion")
+        
+        if file_list:
+            mappings = self._build_mappings(file_list)
+            
+            # Write converted files in parallel
+            tasks = [
+                (path, os.path.join(self.config.CONVERT_RESULT_FOLDER, intermediate_name(path, self.format)))
+                for path in file_list
+            ]
+            self.progress.begin(3, 'write', len(tasks))
+            output_paths = map_in_pool(
+                _convert_merged_file, tasks,
+                workers=self.config.PROCESS_WORKERS,
+                state={"mappings": mappings, "chunk_size": self.config.CHUNK_SIZE},
+                on_result=lambda task, path: self.progress.advance(item=os.path.basename(path))
+            )
+            
+            for file_path, output_path in zip(file_list, output_paths):
+                print(f"Saved converted data to {output_path}")
+                if self.manifest is not None:
+                    self.manifest.record(3, os.path.basename(file_path), fingerprints[file_path], [output_path])
+        
+        if self.manifest is not None:
+            self.manifest.save()
+        
+        if self.cache is not None:
+            stats = self.cache.stats()
+            print(f"Conversion cache: {stats['hits']} hits, {stats['misses']} misses "
+                  f"({stats['hit_rate']:.1%} hit rate)")
     
-    def _convert_single_file(self, file_path: str):
-        """Convert identifiers in a single file"""
-        df = pd.read_csv(file_path)
-        print(f"Processing {file_path}")
+    def _build_mappings(self, file_list: list) -> dict:
+        """Convert the InChIKeys of all files once per target identifier"""
+        print(f"Processing {len(file_list)} files")
+        self.progress.begin(3, 'read', len(file_list))
+        inchikey_lists = map_in_pool(
+            _read_inchikeys, file_list,
+            workers=self.config.PROCESS_WORKERS,
+            state={"chunk_size": self.config.CHUNK_SIZE},
+            on_result=lambda path, keys: self.progress.advance(item=os.path.basename(path))
+        )
+        identifiers = [key for keys in inchikey_lists for key in keys]
         
-        # Convert to each target identifier
+        mappings = {}
         for target in self.config.CONVERSION_TARGETS:
             print(f"Converting to {target}")
             
             # Get conversion results
-            res = self._transform_inchikey(df['InChIKey'].tolist(), target)
-            df[target] = None
-            
-            # Map results back to DataFrame
-            for key, value in res[target].items():
-                if key != 'nan':
-                    row_indices = df.index[df['InChIKey'] == key].tolist()
-                    if row_indices:
-                        df.at[row_indices[0], target] = value
-        
-        # Save converted data
-        output_filename = os.path.basename(file_path)
-        export_file_path = os.path.join(self.config.CONVERT_RESULT_FOLDER, output_filename)
-        df.to_csv(export_file_path, index=False)
-        print(f"Saved converted data to {export_file_path}")
+            res = self._transform_inchikey(identifiers, target)
+            mappings[target] = {key: value for key, value in res.get(target, {}).items() if key != 'nan'}
+        return mappings
     
     def _transform_inchikey(self, identifiers: list, target: str) -> dict:
         """Transform InChIKey to target identifier using CTS API"""
-        if identifiers:
-            result = ct.CTSget(self.config.CONVERSION_SOURCE, target, identifiers)
-        else:
-            result = {}
-        return result
+        source = self.config.CONVERSION_SOURCE
+        identifiers = [i for i in dict.fromkeys(identifiers) if isinstance(i, str)]
+        if not identifiers:
+            return {}
+        
+        # Only identifiers never seen before go to CTS
+        converted = {}
+        if self.cache is not None:
+            converted = self.cache.get_many(source, target, identifiers)
+        pending = [i for i in identifiers if i not in converted]
+        self.progress.begin(3, f'convert to {target}', len(identifiers))
+        self.progress.advance(len(converted))
+        
+        engine = FetchEngine(
+            lambda identifier: self._cts_convert(identifier, target),
+            self.limiter,
+            self.config.CTS_WORKERS
+        )
+        fetched = {}
+        for identifier, value in engine.run(pending):
+            self.progress.advance(item=identifier)
+            if value is not None:
+                fetched[identifier] = value
+        if fetched and self.cache is not None:
+            self.cache.put_many(source, target, fetched)
+        
+        converted.update(fetched)
+        return {target: converted}
+    
+    def _cts_convert(self, identifier: str, target: str) -> str:
+        """
+        Convert a single identifier with the CTS REST API
+        
+        Args:
+            identifier: Identifier in the CONVERSION_SOURCE format
+            target: Target identifier name
+            
+        Returns:
+            First matching target identifier, '' when CTS has no match,
+            or None when the request failed
+        """
+        url = (f'{self.config.CTS_SITE}/rest/convert/'
+               f'{quote(self.config.CONVERSION_SOURCE)}/{quote(target)}/{quote(identifier)}')
+        self.limiter.acquire()
+        try:
+            response = self.session.get(url, timeout=self.config.REQUEST_TIMEOUT)
+            current_metrics().count('cts_requests')
+            current_metrics().count('retries', _retry_count(response))
+            response.raise_for_status()
+            data = response.json()
+        except (RequestException, ValueError) as err:
+            print(f'CTS request error for {identifier}: {err}')
+            return None
+        
+        results = data[0].get('results', []) if data else []
+        return results[0] if results else ''
 
 
 # ================== STEP 4: DATA AGGREGATION ==================
+def _load_long_format(task: tuple, state: dict) -> pd.DataFrame:
+    """Pool task: load a single file as (Title, PubChem CID, sample, Area) rows"""
+    file_path, column_name = task
+    df_input = load_table(file_path, columns=['Title', 'PubChem CID', 'Area'])
+    long_df = df_input[['Title', 'PubChem CID', 'Area']].copy()
+    long_df['Area'] = long_df['Area'].astype(object)  # keep integer areas as written
+    long_df['sample'] = column_name
+    return long_df
+
+
 class DataAggregator:
     """Handle final data aggregation and merging"""
     
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, manifest: PipelineManifest = None,
+                 progress: ProgressReporter = None):
         self.config = config
+        self.manifest = manifest
+        self.progress = progress or ProgressReporter()
     
     def aggregate_data(self):
         """Aggregate all converted data into final merged file"""
-        csv_files = [f for f in os.listdir(self.config.CONVERT_RESULT_FOLDER) 
-                    if f.endswith((".csv", ".xlsx", ".txt"))]
+        if not os.path.isdir(self.config.CONVERT_RESULT_FOLDER):
+            print("No CSV files found to aggregate")
+            return
+        csv_files = [f for f in sorted(os.listdir(self.config.CONVERT_RESULT_FOLDER)) 
+                    if f.endswith(INTERMEDIATE_EXTENSIONS)]
 
         if not csv_files:
             print("No CSV files found to aggregate")
             return
         
+        # The merged file depends on every converted file, in listing order
+        if self.manifest is not None:
+            fingerprint = self.manifest.fingerprint(
+                *[os.path.join(self.config.CONVERT_RESULT_FOLDER, f) for f in csv_files]
+            )
+            if self.manifest.is_current(4, self.config.MERGE_OUTPUT_FILE, fingerprint):
+                print("Incremental mode: aggregated file is up to date")
+                return
+        
         print("Starting to merge these files:")
         print(csv_files)
         
-        # Initialize output DataFrame
-        df_output = pd.DataFrame(columns=['Title', 'PubChem CID'])
+        # Collect all files in long format
+        tasks = [
+            (os.path.join(self.config.CONVERT_RESULT_FOLDER, file_name), file_name.split('.')[0])
+            for file_name in csv_files
+        ]
+        column_names = [column_name for _, column_name in tasks]
+        self.progress.begin(4, 'load', len(tasks))
+        frames = map_in_pool(
+            _load_long_format, tasks,
+            workers=self.config.PROCESS_WORKERS,
+            on_result=lambda task, frame: self.progress.advance(item=task[1])
+        )
         
-        # Process each file
-        for file_name in csv_files:
-            file_path = os.path.join(self.config.CONVERT_RESULT_FOLDER, file_name)
-            df_input = pd.read_csv(file_path)
-            if 'Title' not in df_input.columns and 'Name' in df_input.columns:
-                df_input.rename(columns={'Name': 'Title'}, inplace=True)
-
-            column_name = file_name.split('.')[0]
-            df_output[column_name] = ''
-            
-            # Merge data
-            df_output = self._merge_file_data(df_input, df_output, column_name)
+        # Pivot into one row per Title and one column per sample
+        df_output = self._pivot_long_format(pd.concat(frames, ignore_index=True), column_names)
         
         # Save final result
-        self._save_aggregated_data(df_output)
+        output_path = self._save_aggregated_data(df_output)
+        if self.manifest is not None:
+            self.manifest.record(4, self.config.MERGE_OUTPUT_FILE, fingerprint, [output_path])
+            self.manifest.save()
     
-    def _merge_file_data(self, df_input: pd.DataFrame, df_output: pd.DataFrame, column_name: str) -> pd.DataFrame:
-        """Merge data from a single file into output DataFrame"""
-        for _, row in df_input.iterrows():
-            title = row['Title']
-            area = row['Area']
-            cid = row['PubChem CID']
-            
-            # Check if title already exists
-            existing_row = df_output.loc[df_output['Title'] == title]
-            
-            if not existing_row.empty:
-                # Update existing row
-                df_output.at[existing_row.index[0], column_name] = area
-            else:
-                # Create new row
-                new_row = pd.DataFrame({
-                    'Title': [title],
-                    'PubChem CID': [cid],
-                    column_name: [area]
-                })
-                df_output = pd.concat([df_output, new_row], ignore_index=True)
+    def _pivot_long_format(self, long_df: pd.DataFrame, column_names: list) -> pd.DataFrame:
+        """Pivot long-format rows into the MetaboAnalyst layout"""
+        long_df = long_df[long_df['Title'].notna()]
         
+        # Rows keep the order in which titles first appear; the CID comes from
+        # the first occurrence and the area from the last one within each sample
+        first_seen = long_df.drop_duplicates('Title', keep='first')
+        areas = (
+            long_df.drop_duplicates(['Title', 'sample'], keep='last')
+            .pivot(index='Title', columns='sample', values='Area')
+            .reindex(index=first_seen['Title'], columns=list(dict.fromkeys(column_names)))
+        )
+        
+        df_output = pd.DataFrame({
+            'Title': first_seen['Title'].to_numpy(),
+            'PubChem CID': first_seen['PubChem CID'].to_numpy()
+        })
+        for column_name in areas.columns:
+            df_output[column_name] = areas[column_name].to_numpy()
         return df_output
     
-    def _save_aggregated_data(self, df_output: pd.DataFrame):
+    def _save_aggregated_data(self, df_output: pd.DataFrame) -> str:
         """Save aggregated data to final output file"""
         if not os.path.exists(self.config.METABOANALYST_FOLDER):
             os.makedirs(self.config.METABOANALYST_FOLDER)
@@ -392,36 +2275,200 @@ class DataAggregator:
         )
         
         df_output.to_csv(export_file_path, index=False)
+        current_metrics().count('rows_written', len(df_output))
+        current_metrics().count('bytes_written', os.path.getsize(export_file_path))
         print(f"Merging data completed. Final file saved at: {export_file_path}")
+        return export_file_path
+
+
+# ================== STEP 5: CLASS ROLLUP ==================
+class ClassRollup:
+    """Sum and average sample areas per taxonomy level of the aggregated features"""
+    
+    LEVELS = {
+        'kingdom': 'Kingdom',
+        'superclass': 'Superclass',
+        'class': 'Class',
+        'subclass': 'Subclass',
+        'direct_parent': 'Direct Parent'
+    }
+    UNCLASSIFIED = 'Unclassified'
+    
+    def __init__(self, config: Config, manifest: PipelineManifest = None,
+                 progress: ProgressReporter = None):
+        self.config = config
+        self.manifest = manifest
+        self.progress = progress or ProgressReporter()
+        self.format = resolve_intermediate_format(config)
+    
+    def rollup_classes(self):
+        """Write one rollup file per taxonomy level from the aggregated file"""
+        merge_path = os.path.join(self.config.METABOANALYST_FOLDER, self.config.MERGE_OUTPUT_FILE)
+        if not os.path.exists(merge_path):
+            print("No aggregated file found to roll up")
+            return
+        
+        # The rollups depend on the aggregated areas and on every classification
+        grouping_files = grouping_result_files(self.config.GROUPING_FOLDER)
+        if self.manifest is not None:
+            fingerprint = self.manifest.fingerprint(merge_path, *grouping_files)
+            if self.manifest.is_current(5, self.config.MERGE_OUTPUT_FILE, fingerprint):
+                print("Incremental mode: class rollups are up to date")
+                return
+        
+        merged_df = load_table(merge_path)
+        samples = [column for column in merged_df.columns if column not in ('Title', 'PubChem CID')]
+        taxonomy, lookup = build_class_lookup(load_grouping_results(self.config.GROUPING_FOLDER), "title")
+        nodes = merged_df['Title'].map(lookup).fillna(ChemOntTaxonomy.NONE).astype('int64').to_numpy()
+        node_ids, node_features, node_sums, node_counts = self._sum_by_node(
+            nodes, merged_df[samples].apply(pd.to_numeric, errors='coerce')
+        )
+        
+        os.makedirs(self.config.ROLLUP_FOLDER, exist_ok=True)
+        self.progress.begin(5, 'rollup', len(self.LEVELS))
+        outputs = []
+        for level, label in self.LEVELS.items():
+            names = [self._level_name(taxonomy, int(node), level) for node in node_ids]
+            rollup_df = self._rollup_level(label, names, node_features, node_sums, node_counts, samples)
+            output_path = os.path.join(
+                self.config.ROLLUP_FOLDER, intermediate_name(f"{level}_rollup", self.format)
+            )
+            write_intermediate(rollup_df, output_path)
+            outputs.append(output_path)
+            self.progress.advance(item=level)
+        print(f"Class rollups of {len(merged_df)} features saved to {self.config.ROLLUP_FOLDER}")
+        
+        if self.manifest is not None:
+            self.manifest.record(5, self.config.MERGE_OUTPUT_FILE, fingerprint, outputs)
+            self.manifest.save()
+    
+    def _sum_by_node(self, nodes: np.ndarray, areas: pd.DataFrame) -> tuple:
+        """
+        Reduce the feature x sample area matrix to one row per taxonomy node
+        
+        This is the only pass over the full matrix; every level is then rolled
+        up from the per-node totals, since sums and counts of non-empty areas
+        add up along the taxonomy.
+        
+        Args:
+            nodes: Taxonomy node of each feature, NONE when unclassified
+            areas: Numeric areas, NaN where a sample has no value
+            
+        Returns:
+            (node IDs, features per node, summed areas, non-empty areas per node)
+        """
+        node_ids, codes = np.unique(nodes, return_inverse=True)
+        grouped = pd.DataFrame(areas.to_numpy(dtype=np.float64)).groupby(codes, sort=True)
+        return (
+            node_ids,
+            np.bincount(codes, minlength=len(node_ids)),
+            grouped.sum().to_numpy(),
+            grouped.count().to_numpy()
+        )
+    
+    def _level_name(self, taxonomy: ChemOntTaxonomy, node: int, level: str) -> str:
+        """Name of a node's ancestor at a level, or UNCLASSIFIED"""
+        if level == 'direct_parent':
+            level_node = node
+        else:
+            level_node = taxonomy.rank_node(node, level)
+        if level_node == ChemOntTaxonomy.NONE or taxonomy.names[level_node] is None:
+            return self.UNCLASSIFIED
+        return taxonomy.names[level_node]
+    
+    def _rollup_level(self, label: str, names: list, features: np.ndarray, sums: np.ndarray,
+                      counts: np.ndarray, samples: list) -> pd.DataFrame:
+        """Combine per-node totals into sum and mean rows per class of one level"""
+        names = pd.Series(names)
+        level_features = pd.Series(features).groupby(names).sum()
+        level_sums = pd.DataFrame(sums, columns=samples).groupby(names).sum()
+        level_counts = pd.DataFrame(counts, columns=samples).groupby(names).sum()
+        level_means = level_sums / level_counts.where(level_counts > 0)
+        
+        # Classes in alphabetical order, unclassified features last
+        order = sorted(name for name in level_sums.index if name != self.UNCLASSIFIED)
+        if self.UNCLASSIFIED in level_sums.index:
+            order.append(self.UNCLASSIFIED)
+        
+        frames = []
+        for statistic, values in (('sum', level_sums), ('mean', level_means)):
+            frame = values.reindex(order)
+            frame.insert(0, 'Statistic', statistic)
+            frame.insert(0, 'Features', level_features.reindex(order).to_numpy())
+            frame.insert(0, label, order)
+            frames.append(frame.reset_index(drop=True))
+        
+        # Sum and mean rows of each class next to each other
+        rollup_df = pd.concat(frames)
+        rollup_df['_position'] = np.tile(np.arange(len(order)), 2)
+        rollup_df = rollup_df.sort_values('_position', kind='stable').drop(columns='_position')
+        return rollup_df.reset_index(drop=True)
 
 
 # ================== MAIN PIPELINE ==================
 class ChemicalAnalysisPipeline:
     """Main pipeline orchestrating all processing steps"""
     
-    def __init__(self, config: Config = None):
+    def __init__(self, config: Config = None, workers: int = None, progress=None,
+                 classyfire_limiter: TokenBucket = None, cts_limiter: TokenBucket = None):
+        """
+        Args:
+            config: Pipeline settings, defaults to Config()
+            workers: Overrides config.PROCESS_WORKERS when given
+            progress: Optional callable receiving structured progress events
+            classyfire_limiter: ClassyFire rate limiter shared with other pipelines,
+                a private one following config.API_RATE_LIMIT when None
+            cts_limiter: CTS rate limiter shared with other pipelines,
+                a private one following config.CTS_RATE_LIMIT when None
+        """
         self.config = config or Config()
-        self.classifier = ChemicalClassifier(self.config)
-        self.merger = DataMerger(self.config)
-        self.converter = ChemicalConverter(self.config)
-        self.aggregator = DataAggregator(self.config)
+        if workers is not None:
+            self.config.PROCESS_WORKERS = workers
+        self.session = create_http_session(self.config)
+        self.manifest = None
+        if self.config.INCREMENTAL:
+            self.manifest = PipelineManifest(self.config.MANIFEST_PATH)
+        self.progress = ProgressReporter(progress)
+        self.metrics = RunMetrics()
+        self.report = RunReport(self.config, self.metrics)
+        self.classifier = ChemicalClassifier(
+            self.config, self.session, self.manifest, self.progress, classyfire_limiter
+        )
+        self.merger = DataMerger(self.config, self.manifest, self.progress)
+        self.converter = ChemicalConverter(
+            self.config, self.session, self.manifest, self.progress, cts_limiter
+        )
+        self.aggregator = DataAggregator(self.config, self.manifest, self.progress)
+        self.rollup = ClassRollup(self.config, self.manifest, self.progress)
+    
+    STEP_NAMES = {
+        1: "Chemical classification",
+        2: "Merging classification data",
+        3: "Converting chemical identifiers",
+        4: "Aggregating final data",
+        5: "Rolling up class abundances"
+    }
     
     def run_full_pipeline(self):
         """Run the complete chemical analysis pipeline"""
         print("=== Starting Chemical Analysis Pipeline ===")
+        self.report = RunReport(self.config, self.metrics)
         
         try:
             print("\n1. Running chemical classification...")
-            self.classifier.process_classification_files()
+            self._run_timed(1, self.classifier.process_classification_files)
             
             print("\n2. Merging classification data...")
-            self.merger.merge_classification_data()
+            self._run_timed(2, self.merger.merge_classification_data)
             
             print("\n3. Converting chemical identifiers...")
-            self.converter.convert_identifiers()
+            self._run_timed(3, self.converter.convert_identifiers)
             
             print("\n4. Aggregating final data...")
-            self.aggregator.aggregate_data()
+            self._run_timed(4, self.aggregator.aggregate_data)
+            
+            print("\n5. Rolling up class abundances...")
+            self._run_timed(5, self.rollup.rollup_classes)
             
             print("\n=== Pipeline completed successfully! ===")
             
@@ -435,15 +2482,26 @@ class ChemicalAnalysisPipeline:
             1: self.classifier.process_classification_files,
             2: self.merger.merge_classification_data,
             3: self.converter.convert_identifiers,
-            4: self.aggregator.aggregate_data
+            4: self.aggregator.aggregate_data,
+            5: self.rollup.rollup_classes
         }
         
         if step_number in steps:
             print(f"Running step {step_number}...")
-            steps[step_number]()
+            self._run_timed(step_number, steps[step_number])
             print(f"Step {step_number} completed.")
         else:
             print(f"Invalid step number: {step_number}")
+    
+    def _run_timed(self, step_number: int, run):
+        """Run a step under the run report, saving the report even if the step fails"""
+        try:
+            with self.metrics.activate(), self.report.step(step_number, self.STEP_NAMES[step_number]) as entry:
+                run()
+            print(f"Step {step_number} took {entry['wall_seconds']:.1f}s "
+                  f"({entry['sleep_seconds']:.1f}s rate-limit sleep)")
+        finally:
+            print(f"Run report saved to {self.report.save()}")
 
 
 # ================== USAGE EXAMPLE ==================
@@ -460,6 +2518,7 @@ def main():
     # pipeline.run_step(2)  # Merging only
     # pipeline.run_step(3)  # Conversion only
     # pipeline.run_step(4)  # Aggregation only
+    # pipeline.run_step(5)  # Class rollup only
 
 
 if __name__ == "__main__":
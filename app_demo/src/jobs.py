@@ -0,0 +1,162 @@
+import threading
+import queue
+import traceback
+import uuid
+from datetime import datetime
+
+
+class PipelineJob:
+    """State of a single pipeline run, shared between the worker thread and the UI"""
+
+    MAX_LOGS = 200
+
+    def __init__(self, target):
+        self.job_id = uuid.uuid4().hex[:8]
+        self.target = target
+        self.status = 'queued'  # queued -> running -> done | failed
+        self.progress = 0
+        self.message = 'Waiting in queue...'
+        self.error = None
+        self.created = datetime.now()
+        self.started = None
+        self.finished = None
+        self.logs = []
+        self._lock = threading.Lock()
+
+    def add_log(self, message):
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        with self._lock:
+            self.logs.append(f"[{timestamp}] {message}")
+            if len(self.logs) > self.MAX_LOGS:
+                self.logs = self.logs[-self.MAX_LOGS:]
+
+    def update(self, message=None, progress=None):
+        with self._lock:
+            if message is not None:
+                self.message = message
+            if progress is not None:
+                self.progress = max(0, min(100, int(progress)))
+
+    def start(self):
+        with self._lock:
+            self.status = 'running'
+            self.started = datetime.now()
+
+    def finish(self, error=None):
+        """Mark the job done, or failed with an error message"""
+        with self._lock:
+            self.status = 'failed' if error is not None else 'done'
+            self.error = error
+            if error is None:
+                self.progress = 100
+            self.finished = datetime.now()
+
+    @property
+    def active(self):
+        with self._lock:
+            return self.status in ('queued', 'running')
+
+    def snapshot(self):
+        """Return a consistent copy of the job state for rendering"""
+        with self._lock:
+            return {
+                'job_id': self.job_id,
+                'status': self.status,
+                'progress': self.progress,
+                'message': self.message,
+                'error': self.error,
+                'created': self.created,
+                'started': self.started,
+                'finished': self.finished,
+                'logs': list(self.logs)
+            }
+
+
+class JobRunner:
+    """Server-owned queue running pipeline jobs on background threads
+
+    Jobs outlive the Streamlit script run and browser session that submitted
+    them; pages only poll their state. Up to `workers` jobs run at the same
+    time, so each job must write to its own folders.
+    """
+
+    MAX_JOBS = 50  # finished jobs kept for display
+
+    def __init__(self, workers=1):
+        self._queue = queue.Queue()
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._worker, name=f'pipeline-jobs-{index}', daemon=True)
+            for index in range(max(1, workers))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, target):
+        """Queue target(job) for execution and return the new job ID"""
+        job = PipelineJob(target)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._trim()
+        job.add_log("Job queued")
+        self._queue.put(job)
+        return job.job_id
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self):
+        """Return all known jobs, newest first"""
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda job: job.created, reverse=True)
+
+    def queue_position(self, job_id):
+        """Number of jobs that will run before this one, or 0 if it is running or finished"""
+        with self._lock:
+            queued = sorted(
+                (job for job in self._jobs.values() if job.snapshot()['status'] == 'queued'),
+                key=lambda job: job.created
+            )
+        for position, job in enumerate(queued, start=1):
+            if job.job_id == job_id:
+                return position
+        return 0
+
+    def _trim(self):
+        finished = sorted(
+            (job for job in self._jobs.values() if not job.active),
+            key=lambda job: job.created
+        )
+        for job in finished[:max(0, len(self._jobs) - self.MAX_JOBS)]:
+            del self._jobs[job.job_id]
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            job.start()
+            job.add_log("Job started")
+            try:
+                job.target(job)
+                job.finish()
+                job.add_log("Job completed successfully")
+            except Exception as e:
+                job.finish(error=str(e))
+                job.add_log(f"ERROR: {e}")
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_job_runner(workers=1):
+    """Return the process-wide JobRunner, starting it with `workers` threads on first use"""
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = JobRunner(workers)
+        return _runner
@@ -3,13 +3,13 @@ import os
 import time
 import shutil
 import subprocess
+import threading
 from datetime import datetime
 import logging
-from app_demo.src.core import ChemicalAnalysisPipeline, Config
-import queue
-import io
-import sys
+from app_demo.src.core import ChemicalAnalysisPipeline, Config, TokenBucket, describe_progress
+from app_demo.src.jobs import get_job_runner
 from app_demo.src.title import title_app
+from app_demo.src.watcher import ExportWatcher
 
 # Configure logging
 logging.basicConfig(
@@ -25,59 +25,77 @@ def log_access(message):
     logging.info(f"{current_time} - Processing - {message}")
     print(f"{current_time} - Processing - {message}")
 
+# MS-DIAL drives a single desktop session and export folder, so Task 1 runs one job at a time
+MSDIAL_LOCK = threading.Lock()
+
+# Jobs share one ClassyFire and one CTS request budget, so a lone job still gets the full rate
+CLASSYFIRE_LIMITER = TokenBucket(Config.API_RATE_LIMIT, Config.API_BURST)
+CTS_LIMITER = TokenBucket(Config.CTS_RATE_LIMIT)
+
+# Config paths that each job keeps in its own folder under Config.JOB_FOLDER
+JOB_PATHS = [
+    'SOURCE_FOLDER', 'GROUPING_FOLDER', 'FINAL_RESULT_FOLDER', 'CONVERT_RESULT_FOLDER',
+    'METABOANALYST_FOLDER', 'ROLLUP_FOLDER', 'RUN_REPORT_FOLDER', 'CHECKPOINT_FOLDER',
+    'MANIFEST_PATH'
+]
+
+def job_config(job_id):
+    """Pipeline settings writing every input copy and result of a job to its own folder"""
+    config = Config()
+    job_folder = os.path.join(config.JOB_FOLDER, job_id)
+    for attribute in JOB_PATHS:
+        setattr(config, attribute, os.path.join(job_folder, os.path.basename(getattr(Config, attribute))))
+    return config
+
 def clean_result_folders():
-    """Clean all result folders to start fresh"""
+    """Empty the MS-DIAL export folder before a new run"""
+    folder = Config().SOURCE_FOLDER
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+        log_access(f"Cleaned {folder} folder")
+    os.makedirs(folder, exist_ok=True)
+    log_access(f"Created new {folder} folder")
+
+def prune_job_folders(runner):
+    """Remove the result folders of finished jobs older than Config.JOB_RETENTION_DAYS"""
     config = Config()
-    folders_to_clean = [
-        "data/clean_result",
-        config.GROUPING_FOLDER,
-        config.FINAL_RESULT_FOLDER,
-        config.CONVERT_RESULT_FOLDER,
-        config.METABOANALYST_FOLDER
-    ]
-    
-    for folder in folders_to_clean:
-        if os.path.exists(folder):
-            shutil.rmtree(folder)
-            log_access(f"Cleaned {folder} folder")
-        os.makedirs(folder, exist_ok=True)
-        log_access(f"Created new {folder} folder")
-
-# def check_clean_result_files():
-#     """Check if files exist in data/clean_result folder"""
-#     source_folder = "data/clean_result"
-#     if not os.path.exists(source_folder):
-#         return False, []
-    
-#     excel_files = [f for f in os.listdir(source_folder) if f.endswith('.xlsx')]
-#     return len(excel_files) > 0, excel_files
+    if not os.path.isdir(config.JOB_FOLDER):
+        return
+    active = {job.job_id for job in runner.list_jobs() if job.active}
+    cutoff = time.time() - config.JOB_RETENTION_DAYS * 86400
+    for job_id in os.listdir(config.JOB_FOLDER):
+        folder = os.path.join(config.JOB_FOLDER, job_id)
+        if job_id not in active and os.path.getmtime(folder) < cutoff:
+            shutil.rmtree(folder, ignore_errors=True)
+            log_access(f"Removed results of job {job_id}")
 
-def check_clean_result_files():
-    """Check if files exist in data/clean_result folder"""
-    source_folder = "data/clean_result"
-    
-    log_access("Waiting 5 seconds before checking clean_result files...")
-    print("⏳ Waiting 5 seconds before checking files...")
-    time.sleep(5)  # Delay 5 giây
-
-    if not os.path.exists(source_folder):
-        log_access(f"Folder not found: {source_folder}")
-        print(f"❌ Folder not found: {source_folder}")
-        return False, []
-    
-    # excel_files = [f for f in os.listdir(source_folder) if f.endswith('.xlsx')]
-    
-    excel_files = [
-        f for f in os.listdir(source_folder)
-        if f.lower().endswith(('.xlsx', '.csv', '.txt'))
-    ]
-    
-    file_count = len(excel_files)
+def get_url_job_id():
+    """Job ID kept in the page URL, so a reload finds the job this browser submitted"""
+    if hasattr(st, 'query_params'):
+        return st.query_params.get('job')
+    return st.experimental_get_query_params().get('job', [None])[0]
 
-    log_access(f"Detected {file_count} Excel file(s) in {source_folder}")
-    print(f"📂 Detected {file_count} Excel file(s) in '{source_folder}'")
+def set_url_job_id(job_id):
+    if hasattr(st, 'query_params'):
+        st.query_params['job'] = job_id
+    else:
+        st.experimental_set_query_params(job=job_id)
 
-    return file_count > 0, excel_files
+def session_job_id():
+    """ID of the latest job submitted from this browser session, or None"""
+    if 'job_id' not in st.session_state:
+        st.session_state.job_id = get_url_job_id()
+    return st.session_state.job_id
+
+def create_export_watcher():
+    """Create a watcher on the MS-DIAL export folder using the pipeline settings"""
+    config = Config()
+    return ExportWatcher(
+        config.SOURCE_FOLDER,
+        stable_seconds=config.EXPORT_STABLE_SECONDS,
+        sentinel_suffix=config.EXPORT_SENTINEL_SUFFIX,
+        poll_interval=config.EXPORT_POLL_INTERVAL
+    )
 
 import subprocess
 
@@ -101,52 +119,63 @@ def run_main_script():
         return False
 
 
-class LogCapture:
-    def __init__(self):
-        self.log_queue = queue.Queue()
-        self.logs = []
-        
-    def add_log(self, message):
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        log_entry = f"[{timestamp}] {message}"
-        self.logs.append(log_entry)
-        self.log_queue.put(log_entry)
-        if len(self.logs) > 100:
-            self.logs = self.logs[-100:]
-
-def run_pipeline_step(step_number, pipeline, status_text, log_capture, progress_bar):
-    step_names = {
-        1: "Classification Processing",
-        2: "Data Merging",
-        3: "Identifier Conversion",
-        4: "Final Aggregation"
-    }
-    
-    try:
-        step_name = step_names.get(step_number, f"Step {step_number}")
-        status_text.text(f"Running Task 2, Step {step_number}: {step_name}...")
-        log_capture.add_log(f"Starting Task 2, Step {step_number}: {step_name}")
-        
-        stdout_buffer = io.StringIO()
-        sys.stdout = stdout_buffer
-        
+STEP_NAMES = {
+    1: "Classification Processing",
+    2: "Data Merging",
+    3: "Identifier Conversion",
+    4: "Final Aggregation",
+    5: "Class Abundance Rollup"
+}
+
+def run_pipeline_job(job):
+    """Run Task 1 (MS-DIAL) and Task 2 (classification pipeline) inside a background job"""
+    config = job_config(job.job_id)
+
+    job.update("Task 1: Waiting for MS-DIAL to be free...", 5)
+    with MSDIAL_LOCK:
+        clean_result_folders()
+        job.add_log("Pipeline started - cleaned MS-DIAL export folder")
+
+        # Task 1: MS-DIAL Processing; the watcher is armed first so no export event is missed
+        with create_export_watcher() as watcher:
+            job.update("Task 1: Running MS-DIAL - Processing data files...", 10)
+            if not run_main_script():
+                raise RuntimeError("Task 1 failed: MS-DIAL main.py exited with an error")
+
+            job.update("Task 1: Waiting for MS-DIAL exports to finish writing...", 25)
+            files = watcher.wait(timeout=3600)  # 1 hour maximum wait time
+            if not files:
+                raise TimeoutError("Process timeout - stopping pipeline")
+
+        # Keep this job's exports; the next job empties the shared export folder
+        os.makedirs(config.SOURCE_FOLDER, exist_ok=True)
+        for name in files:
+            shutil.copy2(os.path.join(Config.SOURCE_FOLDER, name), config.SOURCE_FOLDER)
+
+    log_msg = f"Task 1 completed: Files detected in clean_result folder: {len(files)} files"
+    log_access(log_msg)
+    job.add_log(log_msg)
+    job.update("✅ Task 1 completed! Starting Task 2: Chemical Structure Classification", 50)
+
+    # Task 2: Chemical Structure Classification
+    def on_progress(event):
+        # Each step covers 10% of the bar; stages within a step never move it backwards
+        fraction = event['done'] / event['total'] if event['total'] else 0
+        job.update(describe_progress(event), max(job.progress, 50 + (event['step'] - 1 + fraction) * 10))
+
+    pipeline = ChemicalAnalysisPipeline(
+        config, progress=on_progress,
+        classyfire_limiter=CLASSYFIRE_LIMITER, cts_limiter=CTS_LIMITER
+    )
+    for step, step_name in STEP_NAMES.items():
+        job.update(f"Running Task 2, Step {step}: {step_name}...")
+        job.add_log(f"Starting Task 2, Step {step}: {step_name}")
         try:
-            pipeline.run_step(step_number)
-            log_capture.add_log(f"Task 2, Step {step_number} completed successfully")
-            status_text.text(f"Task 2, Step {step_number}: {step_name} completed!")
-            progress_bar.progress(min(100, int(50 + step_number * 12.5)))  # 50% + 12.5% per step
-            return True
-        finally:
-            sys.stdout = sys.__stdout__
-            stdout_content = stdout_buffer.getvalue()
-            if stdout_content.strip():
-                for line in stdout_content.strip().split('\n'):
-                    log_capture.add_log(f"STDOUT: {line}")
-                    
-    except Exception as e:
-        log_capture.add_log(f"ERROR in Task 2, Step {step_number}: {str(e)}")
-        status_text.error(f"Error in Task 2, Step {step_number}: {str(e)}")
-        return False
+            pipeline.run_step(step)
+        except Exception as e:
+            raise RuntimeError(f"Task 2 stopped at step {step}: {e}") from e
+        job.add_log(f"Task 2, Step {step} completed successfully")
+        job.update(f"Task 2, Step {step}: {step_name} completed!", 50 + step * 10)  # 50% + 10% per step
 
 def rerun_app():
     """Handle Streamlit rerun for compatibility"""
@@ -184,12 +213,52 @@ def display_pipeline_info():
     - Create final analysis-ready dataset
     - Output MetaboAnalyst compatible format
     
-    *Steps run automatically in sequence: 1 → 2 → 3 → 4*
+    **Step 5: Class Abundance Rollup**
+    - Sum and average sample areas per taxonomy level
+    - One table per Kingdom, Superclass, Class, Subclass and Direct Parent
+    - Saved in the job's class_rollup folder
+    
+    *Steps run automatically in sequence: 1 → 2 → 3 → 4 → 5*
     """)
 
+def render_job(job, runner, show_logs):
+    """Render the status, progress and logs of a pipeline job"""
+    state = job.snapshot()
+
+    st.markdown("### Processing Status")
+    st.caption(f"Job {state['job_id']} - submitted {state['created'].strftime('%Y-%m-%d %H:%M:%S')}")
+
+    if state['status'] == 'queued':
+        st.info(f"⏳ Waiting in queue (position {runner.queue_position(state['job_id'])})")
+    elif state['status'] == 'running':
+        st.text(state['message'])
+    elif state['status'] == 'done':
+        st.success("✅ Pipeline completed! Task 1 and Task 2 finished successfully.")
+        st.markdown(
+            "<div style='text-align:center; padding:15px; background-color:#D4EDDA; color:#155724; border-radius:8px; font-size:18px;'>"
+            "🎉 Done! Please go to <b>Step 3</b> to view your results."
+            "</div>",
+            unsafe_allow_html=True
+        )
+    else:
+        st.error(f"Pipeline failed: {state['error']}")
+
+    st.markdown("#### Progress")
+    st.progress(state['progress'])
+
+    if show_logs:
+        st.markdown("### Real-time Logs")
+        st.text_area(
+            "Logs:",
+            value="\n".join(state['logs'][-20:]),
+            height=300,  # Larger height
+            disabled=True
+        )
+
 def main():
     title_app("ClassyFire - Chemical Analysis Pipeline")
     display_pipeline_info()
+    runner = get_job_runner(Config.JOB_WORKERS)
     
     # Custom CSS for larger Start Pipeline button and styled progress bar without shadow
     st.markdown("""
@@ -227,186 +296,34 @@ def main():
         </style>
     """, unsafe_allow_html=True)
     
-    # Initialize session state
-    if 'process_running' not in st.session_state:
-        st.session_state.process_running = False
-    if 'task1_completed' not in st.session_state:
-        st.session_state.task1_completed = False
-    if 'main_process' not in st.session_state:
-        st.session_state.main_process = False
-    if 'log_capture' not in st.session_state:
-        st.session_state.log_capture = LogCapture()
-    if 'log_counter' not in st.session_state:
-        st.session_state.log_counter = 0
+    # Initialize session state; after a page reload, reattach to this browser's own job
+    job_id = session_job_id()
     if 'show_logs' not in st.session_state:
         st.session_state.show_logs = False
-    if 'progress_bar' not in st.session_state:
-        st.session_state.progress_bar = None
+
+    job = runner.get(job_id) if job_id else None
 
     # Start button
-    if not st.session_state.process_running:
+    if job is None or not job.active:
         col1, col2, col3 = st.columns([1, 3, 1])  # Wider center column for larger button
         with col2:
             if st.button("🚀 Start Pipeline", type="primary"):
-                clean_result_folders()
-                st.session_state.process_running = True
-                st.session_state.task1_completed = False
-                st.session_state.main_process = run_main_script()
-                st.session_state.log_capture = LogCapture()
-                st.session_state.log_counter = 0
-                st.session_state.log_capture.add_log("Pipeline started - cleaned result folders")
+                prune_job_folders(runner)
+                st.session_state.job_id = runner.submit(run_pipeline_job)
+                set_url_job_id(st.session_state.job_id)
+                log_access(f"Submitted pipeline job {st.session_state.job_id}")
                 rerun_app()
 
     # Log visibility toggle
     st.session_state.show_logs = st.checkbox("Show Logs", value=st.session_state.show_logs)
 
-    # Process running
-    if st.session_state.process_running:
-        st.markdown("### Processing Status")
-        status_container = st.container()
-        progress_container = st.container()
-        log_container = st.container()
-        
-        with status_container:
-            status_text = st.empty()
-        
-        with progress_container:
-            st.markdown("#### Progress")
-            if st.session_state.progress_bar is None:
-                st.session_state.progress_bar = st.progress(0)
-            progress_bar = st.session_state.progress_bar
-        
-        with log_container:
-            if st.session_state.show_logs:
-                st.markdown("### Real-time Logs")
-                log_placeholder = st.empty()
-        
-        max_wait_time = 3600  # 1 hour maximum wait time
-        start_time = time.time()
-        
-        while st.session_state.process_running:
-            current_time = time.time()
-            
-            # Check timeout
-            if current_time - start_time > max_wait_time:
-                st.error("Process timeout - stopping pipeline")
-                st.session_state.log_capture.add_log("ERROR: Process timeout - stopping pipeline")
-                # if st.session_state.main_process:
-                #     st.session_state.main_process.terminate()
-                st.session_state.process_running = False
-                break
-            
-            # Task 1: MS-DIAL Processing
-            has_files, files = check_clean_result_files()
-            if not st.session_state.task1_completed:
-                if st.session_state.main_process:
-                    poll_result = st.session_state.main_process
-                    if has_files:
-                        log_msg = "Task 1: MS-DIAL main script completed successfully"
-                        log_access(log_msg)
-                        st.session_state.log_capture.add_log(log_msg)
-                    # else:
-                    #     log_msg = f"Task 1: MS-DIAL main script failed with return code: {poll_result}"
-                    #     log_access(log_msg)
-                    #     st.session_state.log_capture.add_log(f"ERROR: {log_msg}")
-                    #     st.error(f"Task 1 failed with error code: {poll_result}")
-                    #     st.session_state.process_running = False
-                    #     break
-                        
-                        st.session_state.main_process = None
-                
-                # has_files, files = check_clean_result_files()
-                if has_files:
-                    st.session_state.task1_completed = True
-                    log_msg = f"Task 1 completed: Files detected in clean_result folder: {len(files)} files"
-                    log_access(log_msg)
-                    st.session_state.log_capture.add_log(log_msg)
-                    status_text.success("✅ Task 1 completed! Starting Task 2: Chemical Structure Classification")
-                    progress_bar.progress(50)  # Task 1 = 50%
-                    st.session_state.log_capture.add_log("Starting Task 2: Chemical Structure Classification")
-                    time.sleep(2)  # Brief pause to show Task 1 completion
-                else:
-                    status_text.text("Task 1: Running MS-DIAL - Processing data files...")
-                    progress_bar.progress(25)  # Partial progress for Task 1
-                    time.sleep(2)
-                    # Update log display if enabled
-                    if st.session_state.show_logs:
-                        current_logs = st.session_state.log_capture.logs
-                        st.session_state.log_counter += 1
-                        log_placeholder.text_area(
-                            "Logs:",
-                            value="\n".join(current_logs[-20:]),
-                            height=300,  # Larger height
-                            disabled=True,
-                            key=f"log_{st.session_state.log_counter}"
-                        )
-                    continue
-            
-            # Task 2: Chemical Structure Classification
-            if st.session_state.task1_completed:
-                pipeline = ChemicalAnalysisPipeline(Config())
-                for step in range(1, 5):
-                    success = run_pipeline_step(
-                        step, pipeline, status_text, st.session_state.log_capture, progress_bar
-                    )
-                    
-                    # Update log display if enabled
-                    if st.session_state.show_logs:
-                        current_logs = st.session_state.log_capture.logs
-                        st.session_state.log_counter += 1
-                        log_placeholder.text_area(
-                            "Logs:",
-                            value="\n".join(current_logs[-20:]),
-                            height=300,  # Larger height
-                            disabled=True,
-                            key=f"log_{st.session_state.log_counter}"
-                        )
-                    
-                    if not success:
-                        st.error(f"Task 2 stopped at step {step}")
-                        st.session_state.process_running = False
-                        break
-                    
-                    time.sleep(1)
-                
-                # if st.session_state.process_running:
-                #     st.session_state.process_running = False
-                #     status_text.success("✅ Pipeline completed! Task 1 and Task 2 finished successfully.")
-                #     progress_bar.progress(100)  # Full completion
-                #     st.session_state.log_capture.add_log("Pipeline completed successfully")
-                #     break
-                if st.session_state.process_running:
-                    st.session_state.process_running = False
-                    status_text.success("✅ Pipeline completed! Task 1 and Task 2 finished successfully.")
-                    progress_bar.progress(100)  # Full completion
-                    st.session_state.log_capture.add_log("Pipeline completed successfully")
-
-                    # New message for Step 3
-                    st.markdown(
-                        "<div style='text-align:center; padding:15px; background-color:#D4EDDA; color:#155724; border-radius:8px; font-size:18px;'>"
-                        "🎉 Done! Please go to <b>Step 3</b> to view your results."
-                        "</div>",
-                        unsafe_allow_html=True
-                    )
-                    break
-
-            
-            # Update log display if enabled
-            if st.session_state.show_logs:
-                current_logs = st.session_state.log_capture.logs
-                st.session_state.log_counter += 1
-                log_placeholder.text_area(
-                    "Logs:",
-                    value="\n".join(current_logs[-20:]),
-                    height=300,  # Larger height
-                    disabled=True,
-                    key=f"log_{st.session_state.log_counter}"
-                )
-            
-            time.sleep(2)
-        
-        # if not st.session_state.process_running:
-        #     rerun_app()
+    if job is not None:
+        render_job(job, runner, st.session_state.show_logs)
+
+    # Poll the background job until it finishes
+    if job is not None and job.active:
+        time.sleep(2)
+        rerun_app()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -8,6 +8,7 @@ import io
 import json
 import warnings
 from app_demo.src.title import title_app
+from app_demo.src.p2_processing import job_config, session_job_id
 import zipfile
 from datetime import datetime
 
@@ -35,10 +36,16 @@ def download_result(file_names=None, sample_count=None):
     log_access("Download result")
     title_app("ClassyFire - Download Results")
 
-    folder_path = "data/metaboanalyst_pubchem"
+    job_id = session_job_id()
+    if job_id is None:
+        st.warning("⚠️ No pipeline run found.\n\n➡️ Please go to **Step 2** to run the process.")
+        return
+
+    # Only this session's own job results are shown
+    folder_path = job_config(job_id).METABOANALYST_FOLDER
 
     if not os.path.exists(folder_path):
-        st.warning("📂 The folder 'data/metaboanalyst_pubchem' does not exist.")
+        st.warning(f"📂 No results found for job {job_id}.")
         return
 
     csv_files = [f for f in os.listdir(folder_path) if f.lower().endswith(".csv")]
@@ -0,0 +1,129 @@
+import os
+import time
+import threading
+import zipfile
+import importlib.util
+
+EXPORT_EXTENSIONS = ('.xlsx', '.csv', '.txt')
+TEMP_PREFIXES = ('~$', '.')  # Excel lock files and hidden temp files
+TEMP_SUFFIXES = ('.tmp', '.part', '.crdownload')
+
+
+def _xlsx_complete(path):
+    """An xlsx is a zip whose central directory is written last, so a partial file fails to open"""
+    try:
+        with zipfile.ZipFile(path) as archive:
+            return '[Content_Types].xml' in archive.namelist()
+    except (zipfile.BadZipFile, OSError):
+        return False
+
+
+class ExportWatcher:
+    """
+    Watch a folder for finished exports
+
+    Uses inotify (through watchdog) when it is installed and falls back to
+    polling otherwise. A file counts as complete when a sentinel file next to
+    it exists, when it is an xlsx whose zip structure is intact, or when its
+    size and mtime have been stable for stable_seconds.
+    """
+
+    def __init__(self, folder, extensions=EXPORT_EXTENSIONS, stable_seconds=1.0,
+                 sentinel_suffix='.done', poll_interval=0.1):
+        self.folder = folder
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.stable_seconds = stable_seconds
+        self.sentinel_suffix = sentinel_suffix
+        self.poll_interval = poll_interval
+        self._event = threading.Event()
+        self._observer = None
+        self._seen = {}  # path -> (size, mtime, monotonic time first seen with that size/mtime)
+
+    def start(self):
+        """Start receiving filesystem events, if watchdog is available"""
+        os.makedirs(self.folder, exist_ok=True)
+        if self._observer is None and importlib.util.find_spec('watchdog') is not None:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+
+            handler = FileSystemEventHandler()
+            handler.on_any_event = lambda event: self._event.set()
+            self._observer = Observer()
+            self._observer.schedule(handler, self.folder, recursive=False)
+            self._observer.start()
+        return self
+
+    def stop(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def _is_export(self, name):
+        lower = name.lower()
+        return (lower.endswith(self.extensions)
+                and not lower.startswith(TEMP_PREFIXES)
+                and not lower.endswith(TEMP_SUFFIXES))
+
+    def _is_complete(self, path):
+        if self.sentinel_suffix and os.path.exists(path + self.sentinel_suffix):
+            return True
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if stat.st_size == 0:
+            return False
+        if path.lower().endswith('.xlsx'):
+            return _xlsx_complete(path)
+
+        now = time.monotonic()
+        size, mtime, since = self._seen.get(path, (None, None, now))
+        if (size, mtime) != (stat.st_size, stat.st_mtime):
+            self._seen[path] = (stat.st_size, stat.st_mtime, now)
+            since = now
+        return (time.time() - stat.st_mtime >= self.stable_seconds
+                or now - since >= self.stable_seconds)
+
+    def scan(self):
+        """Return the sorted names of complete exports currently in the folder"""
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted(
+            name for name in os.listdir(self.folder)
+            if self._is_export(name) and self._is_complete(os.path.join(self.folder, name))
+        )
+
+    def wait(self, timeout=None):
+        """
+        Block until at least one complete export exists
+
+        Args:
+            timeout: Seconds to wait, None to wait forever
+
+        Returns:
+            list: Names of complete exports, empty if the timeout expired
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self._event.clear()
+            files = self.scan()
+            if files:
+                return files
+
+            # Events wake us immediately; the timer only re-checks files waiting to settle
+            delay = self.poll_interval
+            if self._observer is not None:
+                delay = self.stable_seconds if self._seen else None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                delay = remaining if delay is None else min(delay, remaining)
+            self._event.wait(delay)
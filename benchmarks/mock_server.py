@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the ClassyFire and CTS web services
+Purpose: Serve deterministic responses with configurable latency, errors and rate limiting
+"""
+
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+ENTITY_PATH = re.compile(r'^/entities/([^/]+)\.json$')
+QUERY_PATH = re.compile(r'^/queries/(\d+)\.json$')
+CTS_PATH = re.compile(r'^/rest/convert/([^/]+)/([^/]+)/([^/]+)$')
+ENTITIES_PER_PAGE = 10  # page size of ClassyFire query results
+
+KINGDOMS = ['Organic compounds', 'Inorganic compounds']
+SUPERCLASSES = ['Lipids and lipid-like molecules', 'Organic acids and derivatives',
+                'Organic oxygen compounds', 'Benzenoids', 'Phenylpropanoids and polyketides']
+CLASSES = ['Fatty Acyls', 'Carboxylic acids and derivatives', 'Organooxygen compounds',
+           'Benzene and substituted derivatives', 'Flavonoids', 'Steroids and steroid derivatives']
+SUBCLASSES = ['Fatty acids and conjugates', 'Amino acids, peptides, and analogues',
+              'Carbohydrates and carbohydrate conjugates', None]
+
+
+def _seed(text: str) -> int:
+    """Stable seed so every run serves the same answer for the same key"""
+    return zlib.crc32(text.encode('utf-8'))
+
+
+def _node(name: str) -> dict:
+    return {'name': name, 'chemont_id': f"CHEMONTID:{_seed(name) % 10000000:07d}"}
+
+
+def build_entity(inchikey: str, unclassified_rate: float = 0.05) -> dict:
+    """Build a ClassyFire entity response, or None if the key should be unknown"""
+    rng = random.Random(_seed(inchikey))
+    if rng.random() < unclassified_rate:
+        return None
+    subclass = rng.choice(SUBCLASSES)
+    return {
+        'inchikey': f"InChIKey={inchikey}",
+        'smiles': 'C' * rng.randint(1, 20),
+        'kingdom': _node(rng.choice(KINGDOMS)),
+        'superclass': _node(rng.choice(SUPERCLASSES)),
+        'class': _node(rng.choice(CLASSES)),
+        'subclass': _node(subclass) if subclass else None,
+        'intermediate_nodes': [_node(f"Intermediate {rng.randint(1, 50)}")
+                               for _ in range(rng.randint(0, 2))],
+        'direct_parent': _node(f"Direct parent {rng.randint(1, 500)}")
+    }
+
+
+def build_conversion(source: str, target: str, identifier: str) -> list:
+    """Build a CTS convert response with zero or one result"""
+    rng = random.Random(_seed(f"{target}/{identifier}"))
+    results = [] if rng.random() < 0.2 else [f"{target[:4].upper()}{rng.randint(1, 999999):06d}"]
+    return [{
+        'fromIdentifier': source,
+        'searchTerm': identifier,
+        'toIdentifier': target,
+        'results': results
+    }]
+
+
+class MockServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server emulating the ClassyFire and CTS endpoints the pipeline uses
+
+    Serves ClassyFire entity lookups, batch structure queries (submitted with
+    POST /queries.json and polled with GET /queries/{id}.json) and CTS
+    conversions.
+
+    Args:
+        port: Port to listen on, 0 picks a free one
+        latency: Seconds added to every response
+        error_rate: Fraction of requests answered with a 500
+        rate_limit: Requests per second allowed before answering 429, None for unlimited
+        retry_after: Retry-After seconds sent with 429 responses
+        seed: Seed for the error injection
+        query_polls: Status polls a batch query answers 'In Queue' before it is done
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, latency: float = 0.0, error_rate: float = 0.0,
+                 rate_limit: float = None, retry_after: int = 1, seed: int = 0,
+                 query_polls: int = 1):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.query_polls = query_polls
+        self.queries = {}  # query ID -> {'identifiers': [(identifier, smiles)], 'polls_left': int}
+        self.stats = {'requests': 0, 'ok': 0, 'not_found': 0, 'errors': 0, 'throttled': 0}
+        self._rng = random.Random(seed)
+        self._window = (0, 0)  # (second, requests served in it)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        """Serve on a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def admit(self) -> str:
+        """Decide how to answer the next request: 'ok', 'throttled' or 'error'"""
+        with self._lock:
+            self.stats['requests'] += 1
+            if self.rate_limit:
+                second = int(time.monotonic())
+                window, served = self._window
+                served = served + 1 if window == second else 1
+                self._window = (second, served)
+                if served > self.rate_limit:
+                    self.stats['throttled'] += 1
+                    return 'throttled'
+            if self.error_rate and self._rng.random() < self.error_rate:
+                self.stats['errors'] += 1
+                return 'error'
+            return 'ok'
+
+    def record(self, outcome: str):
+        with self._lock:
+            self.stats[outcome] += 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real services
+    disable_nagle_algorithm = True  # headers and body are separate writes
+
+    def log_message(self, format, *args):
+        pass
+
+    def _admit(self) -> bool:
+        """Apply latency, rate limiting and error injection; False if already answered"""
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        decision = server.admit()
+        if decision == 'throttled':
+            self._send(429, {'error': 'Too many requests'},
+                       {'Retry-After': str(server.retry_after)})
+            return False
+        if decision == 'error':
+            self._send(500, {'error': 'Internal server error'})
+            return False
+        return True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        payload = self.rfile.read(length)
+        if not self._admit():
+            return
+        if urlparse(self.path).path != '/queries.json':
+            self.server.record('not_found')
+            self._send(404, {'error': 'Not found'})
+            return
+
+        try:
+            query_input = json.loads(payload)['query_input']
+        except (ValueError, KeyError):
+            self._send(422, {'error': 'Invalid query'})
+            return
+        identifiers = []
+        for line in query_input.splitlines():
+            identifier, _, smiles = line.partition('\t')
+            identifiers.append((identifier, smiles))
+
+        server = self.server
+        with server._lock:
+            query_id = len(server.queries) + 1
+            server.queries[query_id] = {'identifiers': identifiers, 'polls_left': server.query_polls}
+        server.record('ok')
+        self._send(201, {'id': query_id, 'label': 'query', 'classification_status': 'In Queue'})
+
+    def do_GET(self):
+        server = self.server
+        if not self._admit():
+            return
+
+        url = urlparse(self.path)
+        query = QUERY_PATH.match(url.path)
+        if query:
+            body = self._query_page(int(query.group(1)), int(parse_qs(url.query).get('page', ['1'])[0]))
+            if body is None:
+                server.record('not_found')
+                self._send(404, {'error': 'Not found'})
+            else:
+                server.record('ok')
+                self._send(200, body)
+            return
+
+        entity = ENTITY_PATH.match(self.path)
+        convert = CTS_PATH.match(self.path)
+        if entity:
+            body = build_entity(unquote(entity.group(1)))
+        elif convert:
+            body = build_conversion(*(unquote(part) for part in convert.groups()))
+        else:
+            body = None
+
+        if body is None:
+            server.record('not_found')
+            self._send(404, {'error': 'Not found'})
+        else:
+            server.record('ok')
+            self._send(200, body)
+
+    def _query_page(self, query_id: int, page: int) -> dict:
+        """Status of a batch query, with one page of entities once it is done"""
+        server = self.server
+        with server._lock:
+            query = server.queries.get(query_id)
+            if query is None:
+                return None
+            if query['polls_left'] > 0:
+                query['polls_left'] -= 1
+                return {'id': query_id, 'classification_status': 'In Queue',
+                        'entities': [], 'invalid_entities': [], 'number_of_pages': 0}
+
+        valid = [(identifier, smiles) for identifier, smiles in query['identifiers'] if smiles]
+        start = (page - 1) * ENTITIES_PER_PAGE
+        entities = []
+        for identifier, smiles in valid[start:start + ENTITIES_PER_PAGE]:
+            # Computed classifications exist for every valid structure
+            entity = build_entity(identifier, unclassified_rate=0)
+            entity['identifier'] = identifier
+            entity['smiles'] = smiles
+            entities.append(entity)
+        return {
+            'id': query_id,
+            'classification_status': 'Done',
+            'entities': entities,
+            'invalid_entities': [{'identifier': identifier} for identifier, smiles
+                                 in query['identifiers'] if not smiles],
+            'number_of_pages': max(1, -(-len(valid) // ENTITIES_PER_PAGE))
+        }
+
+    def _send(self, status: int, body, headers: dict = None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the mock ClassyFire/CTS server")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=float, default=None)
+    args = parser.parse_args()
+
+    server = MockServer(args.port, args.latency, args.error_rate, args.rate_limit)
+    print(f"Mock ClassyFire/CTS server listening on {server.url}")
+    server.serve_forever()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Offline pipeline benchmarks
+Purpose: Time every ChemicalAnalysisPipeline step on synthetic data against a local mock server
+
+Usage (from the repository root):
+    python -m benchmarks.run_benchmarks --sizes 1000 10000 100000
+    python -m benchmarks.run_benchmarks --sizes 1000 --latency 0.05 --rate-limit 50
+    python -m benchmarks.run_benchmarks --compare benchmarks/results/OLD.json
+
+Results are written to benchmarks/results/<timestamp>_<commit>.json with the
+same layout on every commit, so any two files can be compared.
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from app_demo.src.core import ChemicalAnalysisPipeline, Config
+from benchmarks.mock_server import MockServer
+from benchmarks.synthetic import write_study
+
+RESULTS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+REPORTED_COUNTERS = [
+    'rows_read', 'rows_written', 'bytes_read', 'bytes_written',
+    'classyfire_requests', 'cts_requests', 'retries',
+    'classification_cache_hits', 'conversion_cache_hits'
+]
+
+
+def git_revision() -> dict:
+    """Commit the benchmark ran against, and whether the tree had local changes"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': 'unknown', 'dirty': None}
+    return {'commit': commit, 'dirty': dirty}
+
+
+def benchmark_config(args, server_url: str) -> Config:
+    """Pipeline settings pointing at the mock server, with relative data folders"""
+    config = Config()
+    config.CLASSYFIRE_SITE = server_url
+    config.CTS_SITE = server_url
+    config.API_RATE_LIMIT = args.api_rate
+    config.CTS_RATE_LIMIT = args.api_rate
+    config.FETCH_WORKERS = args.fetch_workers
+    config.CTS_WORKERS = args.fetch_workers
+    config.PROCESS_WORKERS = args.workers
+    config.CACHE_ENABLED = args.cache
+    config.CHUNK_SIZE = args.chunk_size
+    config.INTERMEDIATE_FORMAT = args.format
+    config.CLASSYFIRE_BULK = args.bulk
+    config.BULK_POLL_INTERVAL = args.poll_interval
+    return config
+
+
+def run_size(args, rows: int) -> dict:
+    """Run the full pipeline on one synthetic study and summarize its run report"""
+    server = MockServer(latency=args.latency, error_rate=args.error_rate,
+                        rate_limit=args.rate_limit, seed=args.seed)
+    cwd = os.getcwd()
+    with server, tempfile.TemporaryDirectory(prefix='classyfire_bench_') as workdir:
+        os.chdir(workdir)
+        try:
+            config = benchmark_config(args, server.url)
+            write_study(config.SOURCE_FOLDER, rows, args.samples, args.unique_ratio, args.seed)
+
+            pipeline = ChemicalAnalysisPipeline(config)
+            start = time.perf_counter()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                pipeline.run_full_pipeline()
+            total = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+
+    steps = []
+    for step in pipeline.report.steps:
+        steps.append({
+            'step': step['step'],
+            'name': step['name'],
+            'wall_seconds': step['wall_seconds'],
+            'work_seconds': step['work_seconds'],
+            'sleep_seconds': step['sleep_seconds'],
+            'counters': {name: step['counters'].get(name, 0) for name in REPORTED_COUNTERS}
+        })
+    return {
+        'rows': rows,
+        'samples': args.samples,
+        'total_seconds': round(total, 3),
+        'peak_rss_mb': pipeline.report.steps[-1]['peak_rss_mb'] if pipeline.report.steps else {},
+        'server': dict(server.stats),
+        'steps': steps
+    }
+
+
+def print_results(results: list):
+    print(f"{'rows':>8} {'step':>4} {'name':<34} {'wall s':>9} {'work s':>9} {'sleep s':>9}")
+    for result in results:
+        for step in result['steps']:
+            print(f"{result['rows']:>8} {step['step']:>4} {step['name']:<34} "
+                  f"{step['wall_seconds']:>9.3f} {step['work_seconds']:>9.3f} {step['sleep_seconds']:>9.3f}")
+        print(f"{result['rows']:>8} {'':>4} {'total':<34} {result['total_seconds']:>9.3f}")
+
+
+def compare_results(old_path: str, new_path: str):
+    """Print per-step wall times of two result files side by side"""
+    with open(old_path, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)
+
+    old_times = {(r['rows'], s['step']): s['wall_seconds'] for r in old['results'] for s in r['steps']}
+    print(f"Comparing {old['revision']['commit']} -> {new['revision']['commit']}")
+    print(f"{'rows':>8} {'step':>4} {'old s':>9} {'new s':>9} {'change':>8}")
+    for result in new['results']:
+        for step in result['steps']:
+            before = old_times.get((result['rows'], step['step']))
+            if before is None:
+                continue
+            change = f"{step['wall_seconds'] / before:.2f}x" if before else '-'
+            print(f"{result['rows']:>8} {step['step']:>4} {before:>9.3f} "
+                  f"{step['wall_seconds']:>9.3f} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline against a local mock ClassyFire/CTS server")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="peaks per sample file, one benchmark per size")
+    parser.add_argument('--samples', type=int, default=3, help="sample files per study")
+    parser.add_argument('--unique-ratio', type=float, default=0.2,
+                        help="distinct compounds as a fraction of peaks")
+    parser.add_argument('--latency', type=float, default=0.0, help="mock server latency in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with 500")
+    parser.add_argument('--rate-limit', type=float, default=None,
+                        help="requests per second the mock server allows before answering 429")
+    parser.add_argument('--api-rate', type=float, default=None,
+                        help="client-side request rate limit, unlimited by default")
+    parser.add_argument('--fetch-workers', type=int, default=Config.FETCH_WORKERS)
+    parser.add_argument('--workers', type=int, default=Config.PROCESS_WORKERS)
+    parser.add_argument('--chunk-size', type=int, default=None)
+    parser.add_argument('--format', choices=['csv', 'parquet'], default=Config.INTERMEDIATE_FORMAT)
+    parser.add_argument('--cache', action='store_true', help="enable the local caches (empty at start)")
+    parser.add_argument('--bulk', action='store_true', help="classify through batch structure queries")
+    parser.add_argument('--poll-interval', type=float, default=0.5,
+                        help="first bulk query poll interval in seconds")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="result file, defaults to benchmarks/results/<timestamp>_<commit>.json")
+    parser.add_argument('--compare', help="earlier result file to compare this run against")
+    args = parser.parse_args()
+
+    revision = git_revision()
+    results = []
+    for rows in args.sizes:
+        print(f"Benchmarking {args.samples} x {rows} rows...")
+        results.append(run_size(args, rows))
+    print_results(results)
+
+    started = datetime.datetime.now()
+    output = args.output or os.path.join(
+        RESULTS_FOLDER, f"{started.strftime('%Y-%m-%d_%H-%M-%S')}_{revision['commit']}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'revision': revision,
+            'timestamp': started.isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'settings': {key: value for key, value in vars(args).items()
+                         if key not in ('output', 'compare')},
+            'results': results
+        }, f, indent=2)
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        compare_results(args.compare, output)
+
+
+if __name__ == "__main__":
+    main()
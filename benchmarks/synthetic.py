@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic MS-DIAL peak tables for benchmarks
+Purpose: Generate reproducible input tables of any size
+"""
+
+import os
+import random
+import string
+
+import pandas as pd
+
+ADDUCTS = ['[M+H]+', '[M+Na]+', '[M+NH4]+', '[2M+H]+', '[M-H2O+H]+']
+
+
+def random_inchikey(rng: random.Random) -> str:
+    """Build a well-formed (but fictitious) InChIKey"""
+    letters = string.ascii_uppercase
+    skeleton = ''.join(rng.choice(letters) for _ in range(14))
+    stereo = ''.join(rng.choice(letters) for _ in range(8))
+    return f"{skeleton}-{stereo}SA-N"
+
+
+def random_smiles(rng: random.Random) -> str:
+    """Build a simple acyclic SMILES string"""
+    return ''.join(rng.choice(['C', 'C', 'C', 'O', 'N', 'C(=O)', 'C(O)']) for _ in range(rng.randint(2, 20)))
+
+
+def compound_library(size: int, seed: int = 0) -> list:
+    """Return (title, inchikey, smiles) triples shared by all samples of a study"""
+    rng = random.Random(seed)
+    return [(f"Compound {i}", random_inchikey(rng), random_smiles(rng)) for i in range(size)]
+
+
+def generate_peak_table(rows: int, library: list, unknown_rate: float = 0.3,
+                        seed: int = 0) -> pd.DataFrame:
+    """
+    Generate an MS-DIAL peak list
+
+    Args:
+        rows: Number of peaks
+        library: Compounds annotated peaks are drawn from
+        unknown_rate: Fraction of peaks left as 'Unknown' without an InChIKey
+        seed: Random seed
+
+    Returns:
+        DataFrame with the MS-DIAL peak list columns the pipeline reads
+    """
+    rng = random.Random(seed)
+    titles, inchikeys, smiles = [], [], []
+    for _ in range(rows):
+        if rng.random() < unknown_rate:
+            titles.append('Unknown')
+            inchikeys.append(None)
+            smiles.append(None)
+        else:
+            title, inchikey, structure = rng.choice(library)
+            titles.append(title)
+            inchikeys.append(inchikey)
+            smiles.append(structure)
+
+    rt = [round(rng.uniform(0.5, 20.0), 4) for _ in range(rows)]
+    return pd.DataFrame({
+        'PeakID': range(rows),
+        'Title': titles,
+        'Scans': [rng.randint(5, 500) for _ in range(rows)],
+        'RT (min)': rt,
+        'Precursor m/z': [round(rng.uniform(80.0, 1200.0), 4) for _ in range(rows)],
+        'Height': [float(rng.randint(500, 500000)) for _ in range(rows)],
+        'Area': [round(rng.uniform(1e3, 1e7), 5) for _ in range(rows)],
+        'Adduct': [rng.choice(ADDUCTS) for _ in range(rows)],
+        'InChIKey': inchikeys,
+        'SMILES': smiles,
+        'Total score': [round(rng.uniform(50, 100), 1) if key else None for key in inchikeys],
+        'S/N': [round(rng.uniform(3, 200), 2) for _ in range(rows)]
+    })
+
+
+def write_study(folder: str, rows: int, samples: int = 3, unique_ratio: float = 0.2,
+                seed: int = 0) -> list:
+    """
+    Write one tab-separated peak table per sample, as MS-DIAL exports them
+
+    Args:
+        folder: Output folder, created if missing
+        rows: Peaks per sample
+        samples: Number of sample files
+        unique_ratio: Library size as a fraction of rows
+        seed: Random seed
+
+    Returns:
+        Paths of the written files
+    """
+    os.makedirs(folder, exist_ok=True)
+    library = compound_library(max(1, int(rows * unique_ratio)), seed)
+    paths = []
+    for index in range(samples):
+        df = generate_peak_table(rows, library, seed=seed + index + 1)
+        path = os.path.join(folder, f"sample_{index + 1:02d}.txt")
+        df.to_csv(path, sep='\t', index=False)
+        paths.append(path)
+    return paths
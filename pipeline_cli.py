@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+Headless command-line runner for the chemical analysis pipeline
+Purpose: Run ChemicalAnalysisPipeline from a shell or cron, without the Streamlit app
+
+Usage (from any directory):
+    python pipeline_cli.py run --input exports/study_a --output results/study_a
+    python pipeline_cli.py run --input exports/a exports/b exports/c --output results --parallel 2
+    python pipeline_cli.py run --studies studies.txt --output results --steps 4 5
+    python pipeline_cli.py build-snapshot classyfire_dump.jsonl --snapshot results/cache/classyfire_snapshot.idx
+
+A single study writes its result folders directly under --output. Several
+studies each get a sub-folder named after their input folder, run in their own
+process and log to <output>/<study>/pipeline.log. The classification and
+conversion caches are shared by all studies under <output>/cache unless
+--cache-dir is given.
+"""
+
+import argparse
+import datetime
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from app_demo.src.core import ChemicalAnalysisPipeline, Config, build_snapshot_index, describe_progress
+
+# Config attribute -> folder under a study's output directory
+OUTPUT_FOLDERS = {
+    'GROUPING_FOLDER': 'grouping_result',
+    'FINAL_RESULT_FOLDER': 'final_result',
+    'CONVERT_RESULT_FOLDER': 'convert_result',
+    'METABOANALYST_FOLDER': 'metaboanalyst_pubchem',
+    'ROLLUP_FOLDER': 'class_rollup',
+    'RUN_REPORT_FOLDER': 'run_report',
+    'CHECKPOINT_FOLDER': 'checkpoint'
+}
+# Config attribute of the folder each step writes its results to
+STEP_OUTPUT_FOLDERS = {
+    1: 'GROUPING_FOLDER',
+    2: 'FINAL_RESULT_FOLDER',
+    3: 'CONVERT_RESULT_FOLDER',
+    4: 'METABOANALYST_FOLDER',
+    5: 'ROLLUP_FOLDER'
+}
+STUDY_LOG = 'pipeline.log'
+
+
+def read_study_list(path: str) -> list:
+    """Input folders listed one per line; blank lines and '#' comments are skipped"""
+    base = os.path.dirname(os.path.abspath(path))
+    studies = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                studies.append(line if os.path.isabs(line) else os.path.join(base, line))
+    return studies
+
+
+def plan_studies(args) -> list:
+    """
+    Pair every input folder with the output folder of its study
+
+    Returns:
+        (name, input folder, output folder) triples
+
+    Raises:
+        ValueError: If no input is given, an input is missing or two studies share a name
+    """
+    inputs = list(args.input or [])
+    if args.studies:
+        inputs += read_study_list(args.studies)
+    if not inputs:
+        raise ValueError("No studies given, use --input and/or --studies")
+
+    output = os.path.abspath(args.output)
+    single = len(inputs) == 1 and not args.studies
+    studies = []
+    names = set()
+    for folder in inputs:
+        folder = os.path.abspath(folder)
+        name = os.path.basename(folder.rstrip(os.sep))
+        if not os.path.isdir(folder):
+            raise ValueError(f"Input folder not found: {folder}")
+        if name in names:
+            raise ValueError(f"Two studies are named '{name}', input folder names must be unique")
+        names.add(name)
+        studies.append((name, folder, output if single else os.path.join(output, name)))
+    return studies
+
+
+def build_config(args, input_folder: str, output_folder: str, concurrent_studies: int = 1) -> Config:
+    """
+    Pipeline settings for one study
+
+    Args:
+        args: Parsed 'run' arguments
+        input_folder: Folder holding the study's MS-DIAL exports
+        output_folder: Folder receiving the study's result folders
+        concurrent_studies: Studies running at the same time; the request rate
+            limits are split between them since they call the same services
+
+    Returns:
+        Config with every path inside the output and cache folders
+    """
+    config = Config()
+    config.SOURCE_FOLDER = input_folder
+    for attribute, folder in OUTPUT_FOLDERS.items():
+        setattr(config, attribute, os.path.join(output_folder, folder))
+    config.MANIFEST_PATH = os.path.join(output_folder, os.path.basename(Config.MANIFEST_PATH))
+
+    cache_dir = os.path.abspath(args.cache_dir or os.path.join(args.output, 'cache'))
+    config.CACHE_ENABLED = not args.no_cache
+    config.CACHE_PATH = os.path.join(cache_dir, os.path.basename(Config.CACHE_PATH))
+    config.CONVERSION_CACHE_PATH = os.path.join(cache_dir, os.path.basename(Config.CONVERSION_CACHE_PATH))
+    config.SNAPSHOT_PATH = os.path.abspath(args.snapshot) if args.snapshot \
+        else os.path.join(cache_dir, os.path.basename(Config.SNAPSHOT_PATH))
+
+    if args.rate_limit is not None:
+        config.API_RATE_LIMIT = args.rate_limit or None
+    if args.cts_rate_limit is not None:
+        config.CTS_RATE_LIMIT = args.cts_rate_limit or None
+    if config.API_RATE_LIMIT:
+        config.API_RATE_LIMIT /= concurrent_studies
+    if config.CTS_RATE_LIMIT:
+        config.CTS_RATE_LIMIT /= concurrent_studies
+
+    if args.workers is not None:
+        config.PROCESS_WORKERS = args.workers
+    if args.fetch_workers is not None:
+        config.FETCH_WORKERS = args.fetch_workers
+        config.CTS_WORKERS = args.fetch_workers
+    if args.format is not None:
+        config.INTERMEDIATE_FORMAT = args.format
+    if args.chunk_size is not None:
+        config.CHUNK_SIZE = args.chunk_size
+    if args.classyfire_site:
+        config.CLASSYFIRE_SITE = args.classyfire_site
+    if args.cts_site:
+        config.CTS_SITE = args.cts_site
+    config.CLASSYFIRE_BULK = args.bulk
+    config.INCREMENTAL = args.incremental
+    return config
+
+
+def clear_result_folders(config: Config, steps: list = None):
+    """
+    Empty the result folders of the steps about to run (all when None)
+    
+    Merged files carry a timestamp, so results of an earlier run would
+    otherwise be picked up again and duplicate the sample columns. Run
+    reports and the checkpoint journal are kept.
+    """
+    for step in steps or sorted(STEP_OUTPUT_FOLDERS):
+        folder = getattr(config, STEP_OUTPUT_FOLDERS[step])
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+            print(f"Cleaned {folder} folder")
+        os.makedirs(folder, exist_ok=True)
+
+
+def run_study(config: Config, steps: list = None, show_progress: bool = False) -> bool:
+    """Run the requested steps (all when None) of one study, returning whether it succeeded"""
+    progress = (lambda event: print(describe_progress(event), flush=True)) if show_progress else None
+    try:
+        # Incremental runs reuse earlier results; full runs start from empty result folders
+        if not config.INCREMENTAL:
+            clear_result_folders(config, steps)
+        pipeline = ChemicalAnalysisPipeline(config, progress=progress)
+        if steps is None:
+            pipeline.run_full_pipeline()
+        else:
+            for step in steps:
+                pipeline.run_step(step)
+        return True
+    except Exception:
+        traceback.print_exc()
+        return False
+
+
+def _study_process(config: Config, steps: list, show_progress: bool, log_path: str):
+    """Entry point of a study's own process: run it with all output going to its log file"""
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    with open(log_path, 'a', encoding='utf-8', buffering=1) as log:
+        sys.stdout = sys.stderr = log
+        try:
+            print(f"=== {datetime.datetime.now().isoformat(timespec='seconds')} "
+                  f"study input: {config.SOURCE_FOLDER} ===")
+            ok = run_study(config, steps, show_progress)
+        finally:
+            sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    sys.exit(0 if ok else 1)
+
+
+def run_in_process(config: Config, steps: list, show_progress: bool, log_path: str) -> bool:
+    """Run a study in a fresh process, so run metrics and output stay separate per study"""
+    # Spawned rather than forked: the parent runs threads, and the study may start its own pool
+    process = multiprocessing.get_context('spawn').Process(
+        target=_study_process, args=(config, steps, show_progress, log_path)
+    )
+    process.start()
+    process.join()
+    return process.exitcode == 0
+
+
+def command_run(args) -> int:
+    """Run the pipeline on every study, at most args.parallel at a time"""
+    try:
+        studies = plan_studies(args)
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    steps = sorted(set(args.steps)) if args.steps else None
+
+    if len(studies) == 1 and not args.studies:
+        name, input_folder, output_folder = studies[0]
+        print(f"Running study '{name}': {input_folder} -> {output_folder}")
+        ok = run_study(build_config(args, input_folder, output_folder), steps, args.progress)
+        return 0 if ok else 1
+
+    parallel = max(1, min(args.parallel, len(studies)))
+    print(f"Running {len(studies)} studies, {parallel} at a time")
+
+    def run_one(study):
+        name, input_folder, output_folder = study
+        log_path = os.path.join(output_folder, STUDY_LOG)
+        print(f"[{name}] started, log: {log_path}", flush=True)
+        start = time.perf_counter()
+        ok = run_in_process(build_config(args, input_folder, output_folder, parallel),
+                            steps, args.progress, log_path)
+        seconds = time.perf_counter() - start
+        print(f"[{name}] {'completed' if ok else 'FAILED'} in {seconds:.1f}s", flush=True)
+        return name, ok, seconds
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        results = list(executor.map(run_one, studies))
+
+    failed = [name for name, ok, _ in results if not ok]
+    print(f"{len(results) - len(failed)}/{len(results)} studies completed")
+    if failed:
+        print(f"Failed studies: {', '.join(failed)}")
+    return 1 if failed else 0
+
+
+def command_build_snapshot(args) -> int:
+    """Import ClassyFire dumps into the snapshot index used for offline lookups"""
+    try:
+        build_snapshot_index(args.dumps, args.snapshot)
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Run the chemical analysis pipeline without the web interface")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="run pipeline steps on one or more studies")
+    run.add_argument('--input', nargs='+', help="folder(s) of MS-DIAL exports, one per study")
+    run.add_argument('--studies', help="text file listing study input folders, one per line")
+    run.add_argument('--output', required=True,
+                     help="result folder of a single study, or parent folder of one sub-folder per study")
+    run.add_argument('--steps', type=int, nargs='+', choices=sorted(ChemicalAnalysisPipeline.STEP_NAMES),
+                     help="steps to run, all by default")
+    run.add_argument('--parallel', type=int, default=1, help="studies processed at the same time")
+    run.add_argument('--workers', type=int, help="worker processes for per-file work in steps 2-5")
+    run.add_argument('--fetch-workers', type=int, help="concurrent ClassyFire and CTS requests per study")
+    run.add_argument('--rate-limit', type=float,
+                     help="ClassyFire requests per second across all studies, 0 for unlimited")
+    run.add_argument('--cts-rate-limit', type=float,
+                     help="CTS requests per second across all studies, 0 for unlimited")
+    run.add_argument('--cache-dir', help="folder of the shared caches, defaults to <output>/cache")
+    run.add_argument('--no-cache', action='store_true', help="do not read or write the local caches")
+    run.add_argument('--snapshot', help="ClassyFire snapshot index, defaults to <cache-dir>/classyfire_snapshot.idx")
+    run.add_argument('--bulk', action='store_true', help="classify through batch structure queries")
+    run.add_argument('--incremental', action='store_true', help="only recompute files whose inputs changed")
+    run.add_argument('--format', choices=['csv', 'parquet'], help="intermediate result format")
+    run.add_argument('--chunk-size', type=int, help="rows per chunk to stream large tables")
+    run.add_argument('--classyfire-site', help="ClassyFire base URL")
+    run.add_argument('--cts-site', help="CTS base URL")
+    run.add_argument('--progress', action='store_true', help="print progress events")
+    run.set_defaults(func=command_run)
+
+    snapshot = commands.add_parser('build-snapshot', help="import ClassyFire dumps into a snapshot index")
+    snapshot.add_argument('dumps', nargs='+', help="JSONL, JSON or table dumps; later files win")
+    snapshot.add_argument('--snapshot', default=Config.SNAPSHOT_PATH, help="index file to write")
+    snapshot.set_defaults(func=command_build_snapshot)
+    return parser
+
+
+def main() -> int:
+    args = build_parser().parse_args()
+    if args.command == 'run' and args.parallel < 1:
+        build_parser().error("--parallel must be at least 1")
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
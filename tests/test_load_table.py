@@ -0,0 +1,35 @@
+from app_demo.src.core import iter_table_chunks, load_table
+
+ALIGNMENT_EXPORT = (
+    "\t\t\tClass\tA\n"
+    "\t\t\tFile type\tSample\n"
+    "Alignment ID\tAverage Rt(min)\tMetabolite name\tINCHIKEY\tSMILES\tsample_01\n"
+    "0\t1.5\tMeglutol\tNPOAOTPXWNWTSH-UHFFFAOYSA-N\tCC(O)\t227680.8\n"
+    "1\t2.5\tUnknown\t\t\t67058.0\n"
+)
+
+
+def write_alignment(tmp_path):
+    path = tmp_path / 'align.txt'
+    path.write_text(ALIGNMENT_EXPORT, encoding='utf-8')
+    return str(path)
+
+
+def test_alignment_columns_are_normalized(tmp_path):
+    path = write_alignment(tmp_path)
+
+    df = load_table(path, columns=['Title', 'InChIKey'])
+    assert sorted(df.columns) == ['InChIKey', 'Title']
+    assert df['Title'].tolist() == ['Meglutol', 'Unknown']
+
+    chunks = list(iter_table_chunks(path, columns=['Title', 'InChIKey'], chunksize=1))
+    assert [chunk['Title'].tolist() for chunk in chunks] == [['Meglutol'], ['Unknown']]
+    assert sorted(chunks[0].columns) == ['InChIKey', 'Title']
+
+
+def test_no_matching_columns_reads_nothing(tmp_path):
+    path = write_alignment(tmp_path)
+
+    assert load_table(path, columns=['PubChem CID']).columns.tolist() == []
+    chunks = list(iter_table_chunks(path, columns=['PubChem CID'], chunksize=1))
+    assert [chunk.columns.tolist() for chunk in chunks] == [[]]
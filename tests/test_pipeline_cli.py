@@ -0,0 +1,25 @@
+import os
+
+from pipeline_cli import build_parser, build_config, clear_result_folders
+
+
+def test_clear_result_folders_only_empties_steps_run(tmp_path):
+    args = build_parser().parse_args(['run', '--input', str(tmp_path), '--output', str(tmp_path / 'out')])
+    config = build_config(args, str(tmp_path), str(tmp_path / 'out'))
+    stale = {}
+    for attribute in ['FINAL_RESULT_FOLDER', 'METABOANALYST_FOLDER', 'RUN_REPORT_FOLDER']:
+        folder = getattr(config, attribute)
+        os.makedirs(folder)
+        stale[attribute] = os.path.join(folder, 'stale.csv')
+        open(stale[attribute], 'w').close()
+
+    clear_result_folders(config, [4, 5])
+
+    assert os.path.exists(stale['FINAL_RESULT_FOLDER'])
+    assert not os.path.exists(stale['METABOANALYST_FOLDER'])
+    assert os.path.isdir(config.ROLLUP_FOLDER)
+
+    clear_result_folders(config)
+
+    assert not os.path.exists(stale['FINAL_RESULT_FOLDER'])
+    assert os.path.exists(stale['RUN_REPORT_FOLDER'])
@@ -0,0 +1,24 @@
+import pandas as pd
+import pytest
+
+from app_demo.src.core import load_table, write_intermediate
+
+pytest.importorskip('pyarrow')
+
+
+def test_parquet_mixed_type_column(tmp_path):
+    path = str(tmp_path / 'sample.parquet')
+    df = pd.DataFrame({
+        'Title': ['a', 1, None],
+        'Area': [1.5, 2.0, 3.25],
+        'Class': [['Lipids', 'Organic compounds'], [], None]
+    })
+
+    write_intermediate(df, path)
+    result = load_table(path)
+
+    assert result['Title'].tolist()[:2] == ['a', '1']
+    assert pd.isna(result['Title'][2])
+    assert result['Area'].tolist() == [1.5, 2.0, 3.25]
+    assert list(result['Class'][0]) == ['Lipids', 'Organic compounds']
+    assert df['Title'].tolist()[1] == 1  # the caller's frame is left unchanged